@@ -1,35 +1,90 @@
 import io
-from flask import Flask, render_template, request, Response, session, redirect, flash, url_for
+from flask import Flask, Request, render_template, request, Response, session, redirect, flash, url_for, jsonify, abort, g
 from flask_wtf import FlaskForm
-from wtforms import StringField, SubmitField, FloatField, FileField, MultipleFileField, BooleanField
+from wtforms import StringField, SubmitField, FloatField, FileField, MultipleFileField, BooleanField, SelectField
 from wtforms.validators import Length, DataRequired, NumberRange
 from flask_wtf.file import FileAllowed
 from werkzeug.utils import secure_filename
-from data_process import data_process
-from image_process import image_process, image_process_asi
+from data_process import data_process, offset_csv, speed_series
+from image_process import image_process_data, load_channels
+import jobs
+import metrics
+import result_cache
+import workspaces
+import numpy as np
 import os
-import shutil
+import base64
+import math
+import tempfile
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
 
 
 app = Flask(__name__)
 
 app.config['SECRET_KEY'] = 'secretkey'
-app.config['UPLOAD_FOLDER'] = os.path.join('static', 'files')
-if not os.path.exists(os.path.join(os.path.abspath(os.path.dirname(__file__)), app.config['UPLOAD_FOLDER'])):
-    os.makedirs(os.path.join(os.path.abspath(os.path.dirname(__file__)), app.config['UPLOAD_FOLDER']))
-
-if not os.path.exists(os.path.join(os.path.abspath(os.path.dirname(__file__)), app.config['UPLOAD_FOLDER'], 'generated_images')):
-    os.makedirs(os.path.join(os.path.abspath(os.path.dirname(__file__)), app.config['UPLOAD_FOLDER'], 'generated_images'))
+# number of worker processes used to render the frames of one image job
+app.config['IMAGE_PROCESSES'] = int(os.environ.get('IMAGE_PROCESSES', 1))
+# a preview renders about this many frames at this resolution (30x8 inches at 32 dpi gives 960x256 images)
+app.config['PREVIEW_FRAMES'] = 12
+app.config['PREVIEW_DPI'] = 32
+# recordings bigger than this are processed a chunk of rows at a time to bound memory use
+app.config['CHUNKED_PROCESSING_BYTES'] = 32 * 1024 * 1024
+app.config['CHUNK_ROWS'] = 100000
+# uploads are kept in memory up to this size, bigger ones spill to a temporary file. the default keeps
+# the recordings that are processed in chunks out of memory too
+app.config['UPLOAD_SPOOL_SIZE'] = int(os.environ.get('UPLOAD_SPOOL_SIZE', app.config['CHUNKED_PROCESSING_BYTES']))
+# the signals drawn in the browser are decimated to about this many points per line, and never more than the maximum
+app.config['CHART_POINTS'] = 1000
+app.config['CHART_MAX_POINTS'] = 10000
+# number of files of one /api/speed request that are processed at the same time
+app.config['API_WORKERS'] = int(os.environ.get('API_WORKERS', 4))
+
+
+class SpooledRequest(Request):
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        # the processors read the uploads straight from here, without saving them first
+        return tempfile.SpooledTemporaryFile(max_size=app.config['UPLOAD_SPOOL_SIZE'], mode='rb+')
+
+
+app.request_class = SpooledRequest
+
+
+@app.before_request
+def start_timing():
+    g.started = time.perf_counter()
+    metrics.begin_request()
+    metrics.count('bytes_in_total', request.content_length or 0, endpoint=request.endpoint)
+
+
+@app.after_request
+def record_timing(response):
+    # the stages timed while answering go in the Server-Timing header, and everything in the metrics
+    elapsed = time.perf_counter() - g.started
+    timings = metrics.end_request()
+    response.headers['Server-Timing'] = ', '.join(filter(None, [timings, f'total;dur={elapsed * 1000:.1f}']))
+
+    metrics.observe('request_seconds', elapsed, endpoint=request.endpoint)
+    metrics.count('requests_total', endpoint=request.endpoint, status=response.status_code)
+    if response.is_streamed:
+        # streamed responses are counted as they are sent
+        response.response = counted_bytes(response.response, request.endpoint)
+    else:
+        metrics.count('bytes_out_total', response.content_length or 0, endpoint=request.endpoint)
+    metrics.flush()
+    return response
 
 
-def make_archive(source, destination):
-    base = os.path.basename(destination)
-    name = base.split('.')[0]
-    formt = base.split('.')[1]
-    archive_from = os.path.dirname(source)
-    archive_to = os.path.basename(source.strip(os.sep))
-    shutil.make_archive(name, formt, archive_from, archive_to)
-    shutil.move('%s.%s' % (name, formt), destination)
+def counted_bytes(chunks, endpoint):
+    try:
+        for chunk in chunks:
+            metrics.count('bytes_out_total', len(chunk), endpoint=endpoint)
+            yield chunk
+    finally:
+        # the file behind a streamed download is closed by its generator
+        if hasattr(chunks, 'close'):
+            chunks.close()
 
 
 class DataForm(FlaskForm):
@@ -39,6 +94,7 @@ class DataForm(FlaskForm):
                        default=7.0, validators=[DataRequired(), NumberRange(min=0, max=10)])
     end = FloatField('End time for sampling bias calculation:  ',
                      default=9.8, validators=[DataRequired(), NumberRange(min=0, max=10)])
+    chart = BooleanField('Draw the plots in the browser (faster)')
     submit = SubmitField('Submit')
 
 
@@ -57,7 +113,14 @@ class ImageForm(FlaskForm):
     camerarate = FloatField('Input camera frame rate here:  ',
                           default=1000.0)#, validators=[DataRequired(), NumberRange(min=0, max=10000)])
     en1317 = BooleanField('EN 1317 test')
+    encoding = SelectField('Image encoding:  ', default='png',
+                           choices=[('png', 'PNG'),
+                                    ('png-fast', 'PNG, fast compression (bigger zip, faster)'),
+                                    ('png-max', 'PNG, maximum compression (smaller zip, slower)'),
+                                    ('jpeg', 'JPEG'),
+                                    ('raw', 'Raw RGBA buffers (fastest, largest zip)')])
     submit = SubmitField('Submit')
+    preview = SubmitField('Preview')
 
 
 @app.route('/', methods=['GET', 'POST'])
@@ -68,68 +131,145 @@ def index():
         f = form.file.data
 
         filename = secure_filename(f.filename)
-        filepath = os.path.join(
-            os.path.abspath(os.path.dirname(__file__)), app.config['UPLOAD_FOLDER'], filename)
-
-        # delete all existing .csv files in the upload folder to keep it clean
-        path = os.path.join(os.path.abspath(os.path.dirname(__file__)), app.config['UPLOAD_FOLDER'])
-        for ff in os.listdir(path):
-            fff = os.path.join(path, ff)
-            if fff.endswith('.csv'):
-                os.remove(fff)
-
-        # save the new file in the upload folder
-        f.save(filepath)
 
         session['filename'] = filename.split('.csv')[0]
-        session['filepath'] = filepath
         session['start'] = form.start.data
         session['end'] = form.end.data
+        session['chart'] = form.chart.data
 
+        # the upload is processed straight from the request. the result page reads the result back
+        # from the session and the caches, so reloading it does not upload the file again
+        process_upload(f)
         return redirect(url_for('speed_result'))
 
     return render_template('index.html', form=form)
 
 
-@app.route("/speed_result", methods=['GET', 'POST'])
+def process_upload(f):
+    # the parsed data stays in the recording cache for /getCSV and /speed_series.
+    # in chart mode the browser draws the plots from /speed_series, so no image is rendered here
+    processed_values = data_process(f, session['start'], session['end'], chunksize=upload_chunksize(f),
+                                    plot=not session['chart'])
+
+    session['errorflag'] = processed_values['errorflag']
+
+    session['outputfilename'] = processed_values['outputfilename']
+
+    # what /getCSV needs to build the bias corrected file from the cached recording
+    session['recording'] = processed_values['recording']
+    # all three every time, so a failed upload never keeps the biases of the one before it
+    for bias in ('rollbias', 'pitchbias', 'yawbias'):
+        value = processed_values[bias]
+        session[bias] = None if value is None else float(value)
+
+    # the numbers of the result page. the plot is too big for the session cookie, it is read from the result cache
+    session['speed'] = {key: processed_values[key]
+                        for key in ('testID', 'speed_kmh', 'speed_falling', 'rollbias', 'pitchbias', 'yawbias')}
+    session['result'] = None
+    if processed_values['recording'] is not None:
+        session['result'] = result_cache.result_key(processed_values['recording'], session['start'], session['end'])
+
+
+@app.route("/speed_result", methods=['GET'])
 def speed_result():
-    if request.method == 'GET':
-        filepath = session['filepath']
-        start = session['start']
-        end = session['end']
-
-        processed_values = data_process(filepath, start, end)
-        # delete uploaded file
-        os.remove(filepath)
-
-        session['errorflag'] = processed_values['errorflag']
-
-        session['outputfilename'] = processed_values['outputfilename']
-
-        return render_template('speed_result.html',
-                               testID=processed_values['testID'],
-                               speed_kmh=processed_values['speed_kmh'],
-                               imgdata=processed_values['imgdata'],
-                               outputfilename=processed_values['outputfilename'],
-                               speed_falling=processed_values['speed_falling'],
-                               rollbias=processed_values['rollbias'],
-                               pitchbias=processed_values['pitchbias'],
-                               yawbias=processed_values['yawbias'],
-                               starttime=start,
-                               endtime=end
-                               )
-    else:
-        return 'did not work'
+    # the result of the last upload of this session, see index
+    if 'speed' not in session:
+        return redirect(url_for('index'))
+
+    chart = session['chart'] and session['recording'] is not None
+    imgdata = None
+    if not chart and session['result'] is not None:
+        cached = result_cache.get(session['result'])
+        imgdata = None if cached is None else cached['imgdata']
+
+    return render_template('speed_result.html',
+                           outputfilename=session['outputfilename'],
+                           imgdata=imgdata,
+                           starttime=session['start'],
+                           endtime=session['end'],
+                           chart=chart,
+                           **session['speed']
+                           )
    
     
+def upload_chunksize(f):
+    # long recordings are processed in chunks. the size of the upload is where its stream ends
+    f.stream.seek(0, os.SEEK_END)
+    if f.stream.tell() > app.config['CHUNKED_PROCESSING_BYTES']:
+        return app.config['CHUNK_ROWS']
+    return None
+
+
+@app.route('/api/speed', methods=['POST'])
+def api_speed():
+    """Speed calculation for scripts: no form, session or CSRF token, and JSON out.
+
+    Takes one or more csv uploads named file, and the bias window as start and end, either once for all
+    the files or once per file in the same order. With offset=1 every result also has the bias corrected
+    csv as text, and with plot=1 the speed plot as a base64 png. The files are processed in parallel and
+    the results come back as a list in the order of the files.
+    """
+    files = request.files.getlist('file')
+    if not files:
+        return jsonify(error='no csv files were uploaded, send them as file'), 400
+
+    windows = []
+    for name, default in (('start', 7.0), ('end', 9.8)):
+        values = request.values.getlist(name) or [default]
+        if len(values) == 1:
+            values = values * len(files)
+        if len(values) != len(files):
+            return jsonify(error=f'got {len(values)} {name} values for {len(files)} files'), 400
+        try:
+            windows.append([float(value) for value in values])
+        except ValueError:
+            return jsonify(error=f'{name} has to be a number'), 400
+
+    offset = request.values.get('offset', '').lower() in ('1', 'true', 'yes', 'on')
+    plot = request.values.get('plot', '').lower() in ('1', 'true', 'yes', 'on')
+
+    with ThreadPoolExecutor(max_workers=min(len(files), app.config['API_WORKERS'])) as executor:
+        results = list(executor.map(speed_api_result, files, *windows,
+                                    [offset] * len(files), [plot] * len(files)))
+    return jsonify(results)
+
+
+def speed_api_result(f, start, end, offset, plot):
+    # one file of /api/speed. parsing and the numpy work let go of the GIL, so threads are enough
+    result = {'filename': f.filename, 'starttime': start, 'endtime': end, 'errorflag': 1}
+    try:
+        processed_values = data_process(f, start, end, chunksize=upload_chunksize(f), plot=plot, keep_data=offset)
+    except Exception as e:
+        print(f'WARNING: {f.filename} could not be processed ({e!r})')
+        return dict(result, error=f'the file could not be processed ({e!r})')
+
+    for key in ('testID', 'speed_kmh', 'speed_falling', 'rollbias', 'pitchbias', 'yawbias', 'errorflag'):
+        value = processed_values[key]
+        # a bias window without samples gives NaN, which is not valid json
+        result[key] = None if isinstance(value, float) and math.isnan(value) else value
+    if plot:
+        result['imgdata'] = processed_values['imgdata']
+
+    if offset and processed_values['errorflag'] == 0:
+        # from the data parsed for this request, which the other files of the request cannot evict
+        # from the recording cache
+        csv = offset_csv(processed_values['data'], processed_values['rollbias'],
+                         processed_values['pitchbias'], processed_values['yawbias'])
+        result['offset_csv'] = ''.join(csv)
+    return result
+
+
 @app.route("/getCSV")
 def getCSV():
-    fullfilepath = f'{session["outputfilename"]}.csv'
-    with open(fullfilepath) as fp:
-        csv = fp.read()
+    # stream the bias corrected data straight from the parsed recording, a chunk of rows at a time.
+    # only a successful result has biases to correct it with
+    biases = [session.get(bias) for bias in ('rollbias', 'pitchbias', 'yawbias')]
+    if session.get('errorflag', 1) or not session.get('recording') or None in biases:
+        return 'there is no processed data to download, please upload the file again'
 
-    # delete csv file to keep it clean
-    os.remove(fullfilepath)
+    csv = offset_csv(session['recording'], *biases)
+    if csv is None:
+        return 'the processed data is no longer available, please upload the file again'
 
     return Response(
         csv,
@@ -138,6 +278,27 @@ def getCSV():
                   f"attachment; filename={session['filename']}_OFFSET.csv"})
 
 
+@app.route("/speed_series")
+def speed_series_json():
+    # the plots of the last speed result of this session, for drawing them in the browser
+    try:
+        points = int(request.args.get('points', app.config['CHART_POINTS']))
+    except ValueError:
+        abort(400)
+    points = min(max(points, 2), app.config['CHART_MAX_POINTS'])
+
+    series = speed_series(session['recording'], points) if session.get('recording') else None
+    if series is None:
+        abort(404)
+    return jsonify(dict(series, starttime=session['start'], endtime=session['end']))
+
+
+@app.route('/metrics')
+def metrics_page():
+    # stage timings and counters of all the web workers, for Prometheus
+    return Response(metrics.exposition(), mimetype='text/plain; version=0.0.4')
+
+
 @app.route('/ip_notebook',methods=['GET'])
 def ip_notebook():
     return render_template('ip_notebook.html')
@@ -158,128 +319,136 @@ def image_generator():
     form = ImageForm()
 
     if form.validate_on_submit():
-        fx = form.xfile.data
-        fy = form.yfile.data
-        fz = form.zfile.data
-        frpy = form.rpyfile.data
-
-
-        filenamex = secure_filename(fx.filename)
-        filepathx = os.path.join(
-            os.path.abspath(os.path.dirname(__file__)), app.config['UPLOAD_FOLDER'], filenamex)
-        filenamey = secure_filename(fy.filename)
-        filepathy = os.path.join(
-            os.path.abspath(os.path.dirname(__file__)), app.config['UPLOAD_FOLDER'], filenamey)
-        filenamez = secure_filename(fz.filename)
-        filepathz = os.path.join(
-            os.path.abspath(os.path.dirname(__file__)), app.config['UPLOAD_FOLDER'], filenamez)
-        filenamerpy = secure_filename(frpy.filename)
-        filepathrpy = os.path.join(
-            os.path.abspath(os.path.dirname(__file__)), app.config['UPLOAD_FOLDER'], filenamerpy)
-
-        # delete all existing .csv files in the upload folder to keep it clean
-        path = os.path.join(os.path.abspath(os.path.dirname(__file__)), app.config['UPLOAD_FOLDER'])
-        for ff in os.listdir(path):
-            fff = os.path.join(path, ff)
-            if fff.endswith('.csv'):
-                os.remove(fff)
-
-        # delete all existing .png files in the upload/generated_images folder to keep it clean
-        path = os.path.join(os.path.abspath(os.path.dirname(__file__)), app.config['UPLOAD_FOLDER'], 'generated_images')
-        for ff in os.listdir(path):
-            fff = os.path.join(path, ff)
-            if fff.endswith('.png'):
-                os.remove(fff)
-
-        # save the new files in the upload folder
-        fx.save(filepathx)
-        fy.save(filepathy)
-        fz.save(filepathz)
-        frpy.save(filepathrpy)
-
-        session['filenamex'] = filenamex.split('.csv')[0]
-        session['filepathx'] = filepathx
-        session['filenamey'] = filenamey.split('.csv')[0]
-        session['filepathy'] = filepathy
-        session['filenamez'] = filenamez.split('.csv')[0]
-        session['filepathz'] = filepathz
-        session['filenamerpy'] = filenamerpy.split('.csv')[0]
-        session['filepathrpy'] = filepathrpy
+        # the uploads are parsed straight from the request. only the channels that get plotted are kept,
+        # in a workspace of this upload, for the preview and the render
+        asi = form.asifile.data if form.en1317.data and form.asifile.data else None
+        try:
+            data = load_channels(float(form.final.data), form.xfile.data, form.yfile.data, form.zfile.data,
+                                 form.rpyfile.data, asi=asi)
+        except (TypeError, ValueError) as e:
+            print(f'WARNING: {e}. Double check that you are uploading the correct files.')
+            return 'image processing failed'
+
+        workspace = workspaces.create()
+        np.savez(workspaces.path(workspace, 'channels.npz'), **data)
+
+        session['workspace'] = workspace
         session['oiv'] = form.oiv.data
         session['final'] = form.final.data
         session['camerarate'] = form.camerarate.data
-        session['en1317'] = form.en1317.data
-        session['filepathasi'] = None
-        session['filenameasi'] = None
-
-        # asi file is optional. only save it if it exists
-        fasi = form.asifile.data
-        if fasi:
-            filenameasi = secure_filename(fasi.filename)
-            filepathasi = os.path.join(
-                os.path.abspath(os.path.dirname(__file__)), app.config['UPLOAD_FOLDER'], filenameasi)
-            fasi.save(filepathasi)
-            session['filenameasi'] = filenameasi.split('.csv')[0]
-            session['filepathasi'] = filepathasi
+        session['en1317'] = asi is not None
+        session['encoding'] = form.encoding.data
+
+        # a preview keeps the parsed files so the full run can start from them afterwards
+        if form.preview.data:
+            return redirect(url_for('image_preview'))
 
         return redirect(url_for('image_response'))
 
     return render_template('image_generator.html', form=form)
 
 
-@app.route('/image_response', methods=['GET', 'POST'])
-def image_response():
-    if request.method == 'GET':
-        if session['en1317'] and session['filepathasi']:
-            print('running en1317 test images')
-            succeeded = image_process_asi(session['filepathx'], session['filepathy'], session['filepathz'],
-                                          session['filepathrpy'], session['filepathasi'], session['oiv'],
-                                          session['final'], session['camerarate'])
-        else:
-            print('running mash test images')
-            succeeded = image_process(session['filepathx'], session['filepathy'], session['filepathz'],
-                                      session['filepathrpy'], session['oiv'], session['final'], session['camerarate'])
-
-        if not succeeded:
-            return 'image processing failed'
+def saved_channels():
+    # the channels parsed from the uploads of this session, or None once its workspace has expired
+    if not workspaces.touch(session.get('workspace')):
+        return None
+    with np.load(workspaces.path(session['workspace'], 'channels.npz')) as channels:
+        return dict(channels)
 
-        source = os.path.join(os.path.dirname(__file__), 'static', 'files', 'generated_images')
-        destination = os.path.join(os.path.dirname(__file__), 'static', 'generated_images.zip')
-        make_archive(source, destination)
 
-        # delete all existing .png files in the upload/generated_images folder to keep it clean
-        path = os.path.join(os.path.abspath(os.path.dirname(__file__)), app.config['UPLOAD_FOLDER'], 'generated_images')
-        for ff in os.listdir(path):
-            fff = os.path.join(path, ff)
-            if fff.endswith('.png'):
-                os.remove(fff)
+@app.route('/image_preview', methods=['GET'])
+def image_preview():
+    data = saved_channels()
+    if data is None:
+        return 'the uploaded files are no longer available, please upload them again'
 
-        # delete all existing .csv files in the upload folder to keep it clean
-        path = os.path.join(os.path.abspath(os.path.dirname(__file__)), app.config['UPLOAD_FOLDER'])
-        for ff in os.listdir(path):
-            fff = os.path.join(path, ff)
-            if fff.endswith('.csv'):
-                os.remove(fff)
+    try:
+        frames_total = float(session['final']) * float(session['camerarate']) + 10
+    except (TypeError, ValueError):
+        return 'image processing failed'
 
-        return render_template('image_response.html')
+    # every step-th frame at low resolution, kept in memory and embedded in the page
+    step = max(1, math.ceil(frames_total / app.config['PREVIEW_FRAMES']))
+    buf = io.BytesIO()
+    succeeded = image_process_data(data, session['oiv'], session['final'], session['camerarate'], buf,
+                                   encoding='png-fast', step=step, dpi=app.config['PREVIEW_DPI'])
 
+    if not succeeded:
+        return 'image processing failed'
 
-@app.route("/getZIP")
-def getZIP():
-    fullfilepath = os.path.join(os.path.dirname(__file__), 'static', 'generated_images.zip')
-    with open(fullfilepath, 'rb') as fz:
-        zipped = fz.read()
+    with zipfile.ZipFile(buf) as archive:
+        images = [base64.b64encode(archive.read(name)).decode('ascii') for name in archive.namelist()]
 
-    # delete zip file to keep it clean
-    os.remove(fullfilepath)
+    return render_template('image_preview.html', images=images, step=step)
+
+
+@app.route('/image_response', methods=['GET', 'POST'])
+def image_response():
+    if request.method == 'GET':
+        data = saved_channels()
+        if data is None:
+            return 'the uploaded files are no longer available, please upload them again'
+        print('running en1317 test images' if 'ASI' in data else 'running mash test images')
+
+        # the render runs as a background job in a workspace of its own. the page of the job follows its progress
+        job_id = jobs.create('generated_images.zip')
+        # the frames are written straight into the zip file that the job result sends
+        jobs.start(job_id, image_process_data, data, session['oiv'], session['final'], session['camerarate'],
+                   jobs.result_path(job_id), processes=app.config['IMAGE_PROCESSES'], encoding=session['encoding'])
+        session['job'] = job_id
+
+        return redirect(url_for('job_page', job_id=job_id))
+
+
+@app.route('/jobs/<job_id>')
+def job_page(job_id):
+    if jobs.read_status(job_id) is None:
+        abort(404)
+    return render_template('image_response.html', job_id=job_id)
+
+
+@app.route('/jobs/<job_id>/status')
+def job_status(job_id):
+    # polled by the job page: state is queued, running, done or failed, done/total counts the frames
+    status = jobs.read_status(job_id)
+    if status is None:
+        abort(404)
+    return jsonify(status)
+
+
+@app.route('/jobs/<job_id>/result')
+def job_result(job_id):
+    status = jobs.read_status(job_id)
+    if status is None or status['state'] != 'done':
+        abort(404)
+
+    fullfilepath = jobs.result_path(job_id)
+    fz = open(fullfilepath, 'rb')
+
+    def generate():
+        # send the zip file in pieces instead of reading all of it into memory
+        # the zip file stays in the workspace of the job until it expires, so it can be downloaded again
+        try:
+            while chunk := fz.read(64 * 1024):
+                yield chunk
+        finally:
+            fz.close()
 
     return Response(
-        zipped,
+        generate(),
         mimetype="application/zip",
         headers={"Content-disposition":
                      f"attachment; filename=generated_images.zip"}
     )
 
+
+@app.route("/getZIP")
+def getZIP():
+    # the result of the last image job of this session
+    if 'job' not in session:
+        abort(404)
+    return redirect(url_for('job_result', job_id=session['job']))
+
 if __name__ == '__main__':
     app.run(debug=False)
     
\ No newline at end of file
@@ -0,0 +1,115 @@
+"""Run the speed calculation over a whole test campaign.
+
+    python batch_process.py campaign/ other/*.csv --output results/
+
+Every csv gets its bias corrected _OFFSET file, and one summary.csv lists the speeds and
+biases of all of them. The files are processed in parallel, one per worker process.
+"""
+import argparse
+import base64
+import glob
+import os
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+from data_process import data_process, offset_csv
+
+
+# same as the app: bigger recordings are processed a chunk of rows at a time to bound memory use
+CHUNKED_PROCESSING_BYTES = 32 * 1024 * 1024
+CHUNK_ROWS = 100000
+
+SUMMARY_COLUMNS = ['filename', 'testID', 'speed_leading', 'speed_falling',
+                   'rollbias', 'pitchbias', 'yawbias', 'errorflag']
+
+
+def find_csv_files(paths):
+    """Expand directories and glob patterns into a sorted list of csv files.
+
+    _OFFSET files from an earlier run in the same directory are left out.
+    """
+    filenames = set()
+    for path in paths:
+        if os.path.isdir(path):
+            matches = glob.glob(os.path.join(path, '*.csv'))
+        else:
+            matches = glob.glob(path)
+        filenames.update(os.path.abspath(match) for match in matches if os.path.isfile(match))
+    return sorted(filename for filename in filenames if not filename.endswith('_OFFSET.csv'))
+
+
+def process_file(filename, starttime, endtime, output_folder=None, plot=False):
+    """Run data_process on one file and write its outputs. Returns its row of the summary."""
+    base = os.path.splitext(os.path.basename(filename))[0]
+    if output_folder is None:
+        output_folder = os.path.dirname(filename)
+    summary = dict.fromkeys(SUMMARY_COLUMNS)
+    summary.update(filename=filename, errorflag=1)
+
+    chunksize = CHUNK_ROWS if os.path.getsize(filename) > CHUNKED_PROCESSING_BYTES else None
+    try:
+        result = data_process(filename, starttime, endtime, chunksize=chunksize, plot=plot, keep_data=True)
+    except Exception as e:
+        print(f'WARNING: {filename} could not be processed ({e!r})')
+        return summary
+
+    summary.update(testID=result['testID'],
+                   speed_leading=result['speed_kmh'],
+                   speed_falling=result['speed_falling'],
+                   rollbias=result['rollbias'],
+                   pitchbias=result['pitchbias'],
+                   yawbias=result['yawbias'],
+                   errorflag=result['errorflag'])
+
+    if result['imgdata'] is not None:
+        with open(os.path.join(output_folder, base + '.png'), 'wb') as f:
+            f.write(base64.b64decode(result['imgdata']))
+
+    if result['errorflag'] == 0:
+        # from the data this worker just parsed, which other workers cannot evict from the recording cache
+        csv = offset_csv(result['data'], result['rollbias'], result['pitchbias'], result['yawbias'])
+        with open(os.path.join(output_folder, base + '_OFFSET.csv'), 'w', newline='') as f:
+            f.writelines(csv)
+
+    print(f'... {os.path.basename(filename)}: errorflag {summary["errorflag"]}')
+    return summary
+
+
+def batch_process(filenames, starttime, endtime, output_folder=None, plot=False, processes=None):
+    """Process the files in a pool of worker processes and return the summary as a dataframe."""
+    if output_folder is not None:
+        os.makedirs(output_folder, exist_ok=True)
+
+    n = len(filenames)
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        rows = list(executor.map(process_file, filenames, [starttime] * n, [endtime] * n,
+                                 [output_folder] * n, [plot] * n))
+    return pd.DataFrame(rows, columns=SUMMARY_COLUMNS)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the speed calculation over a directory or glob of csv files.')
+    parser.add_argument('paths', nargs='+', help='csv files, directories or glob patterns')
+    parser.add_argument('--start', type=float, default=7.0, help='start time for the sampling bias calculation')
+    parser.add_argument('--end', type=float, default=9.8, help='end time for the sampling bias calculation')
+    parser.add_argument('--output', help='folder for the output files, next to each input file by default')
+    parser.add_argument('--summary', help='summary csv, summary.csv in the output folder by default')
+    parser.add_argument('--plot', action='store_true', help='also save the speed plot of every file')
+    parser.add_argument('--processes', type=int, default=os.cpu_count(), help='number of worker processes')
+    args = parser.parse_args()
+
+    filenames = find_csv_files(args.paths)
+    if not filenames:
+        print('WARNING: no csv files found')
+        return 1
+
+    summary = batch_process(filenames, args.start, args.end, output_folder=args.output, plot=args.plot,
+                            processes=args.processes)
+
+    summaryfile = args.summary or os.path.join(args.output or '.', 'summary.csv')
+    summary.to_csv(summaryfile, index=False)
+    print(f'{(summary.errorflag == 0).sum()} of {len(summary)} files processed, summary in {summaryfile}')
+    return 0 if (summary.errorflag == 0).all() else 1
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
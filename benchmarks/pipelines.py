@@ -0,0 +1,241 @@
+"""Latency, peak memory and frame rate of the full processing paths on synthetic inputs.
+
+Run from the repository root:
+
+    python -m benchmarks.pipelines
+
+data_process, image_process and image_process_asi are run across recording lengths, final times and
+camera rates, and the Flask endpoints are driven through the test client. Every case runs in a fresh
+process with empty caches, so its peak RSS is its own (job and render worker processes are not counted).
+cold_ms is the first run and warm_ms the median of the repeats, which may be answered from the recording
+and result caches. The table is printed and saved as csv, so the numbers can be compared between releases.
+"""
+import argparse
+import io
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import zipfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from benchmarks.synthetic import daq_recording, image_inputs
+
+
+# seconds of DAQ recording at the 30008 Hz of the rig
+DURATIONS = [1, 10.5, 30]
+FINALS = [0.05, 0.1, 0.2]
+CAMERARATES = [500, 1000]
+# runs after the first one
+REPEATS = 2
+# recordings sent in one /api/speed request
+API_FILES = 4
+
+OUTPUT = os.path.join(os.path.dirname(__file__), 'results', 'pipelines.csv')
+
+
+def cases(durations=DURATIONS, finals=FINALS, camerarates=CAMERARATES):
+    for duration in durations:
+        yield {'pipeline': 'data_process', 'duration_s': duration}
+    for pipeline in ('image_process', 'image_process_asi'):
+        for final in finals:
+            for camerarate in camerarates:
+                yield {'pipeline': pipeline, 'final_s': final, 'camerarate': camerarate}
+
+    yield {'pipeline': 'POST /', 'duration_s': 10.5}
+    yield {'pipeline': 'POST /api/speed', 'duration_s': 10.5, 'files': API_FILES}
+    yield {'pipeline': 'GET /image_preview', 'final_s': max(finals), 'camerarate': max(camerarates)}
+    yield {'pipeline': 'image job', 'final_s': max(finals), 'camerarate': max(camerarates)}
+
+
+def make_inputs(folder, durations=DURATIONS):
+    """Write the synthetic inputs of all the cases into folder and return their paths by name."""
+    inputs = image_inputs(os.path.join(folder, 'images'))
+    for duration in set(durations) | {10.5}:
+        inputs[f'daq {duration}'] = daq_recording(os.path.join(folder, f'daq_{duration}.csv'), duration)
+    for i in range(API_FILES):
+        inputs[f'api {i}'] = daq_recording(os.path.join(folder, f'api_{i}.csv'), 10.5, test_id=f'SYN-{i:03}',
+                                           seed=i + 1)
+    return inputs
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def zip_frames(source):
+    with zipfile.ZipFile(source) as archive:
+        return len(archive.namelist())
+
+
+def data_process_runner(case, inputs, scratch):
+    from data_process import data_process
+    from batch_process import CHUNKED_PROCESSING_BYTES, CHUNK_ROWS
+
+    path = inputs[f'daq {case["duration_s"]}']
+    chunksize = CHUNK_ROWS if os.path.getsize(path) > CHUNKED_PROCESSING_BYTES else None
+    case['chunked'] = chunksize is not None
+
+    def run():
+        result = data_process(path, 7, 9.8, chunksize=chunksize)
+        assert result['errorflag'] == 0
+        return 0
+    return run
+
+
+def image_runner(case, inputs, scratch):
+    import image_process
+
+    destination = os.path.join(scratch, 'generated_images.zip')
+    channels = [inputs[name] for name in ('x', 'y', 'z', 'rpy')]
+    if case['pipeline'] == 'image_process_asi':
+        channels.append(inputs['asi'])
+
+    def run():
+        function = getattr(image_process, case['pipeline'])
+        assert function(*channels, 0.01, case['final_s'], case['camerarate'], destination=destination)
+        return zip_frames(destination)
+    return run
+
+
+def flask_runner(case, inputs, scratch):
+    from app import app
+    app.config['WTF_CSRF_ENABLED'] = False
+    client = app.test_client()
+
+    def upload(path):
+        return open(path, 'rb'), os.path.basename(path)
+
+    def image_form(preview):
+        data = {name + 'file': upload(inputs[name]) for name in ('x', 'y', 'z', 'rpy')}
+        data.update(oiv=0.01, final=case['final_s'], camerarate=case['camerarate'])
+        if preview:
+            data['preview'] = 'Preview'
+        response = client.post('/image_generator', data=data, content_type='multipart/form-data')
+        assert response.status_code == 302, response.data
+        return response.location
+
+    def speed():
+        response = client.post('/', data={'file': upload(inputs['daq 10.5']), 'start': 7, 'end': 9.8},
+                               content_type='multipart/form-data', follow_redirects=True)
+        assert response.status_code == 200 and b'km/h' in response.data
+        return 0
+
+    def api_speed():
+        files = [upload(inputs[f'api {i}']) for i in range(case['files'])]
+        response = client.post('/api/speed', data={'file': files, 'start': 7, 'end': 9.8},
+                               content_type='multipart/form-data')
+        assert response.status_code == 200
+        assert all(result['errorflag'] == 0 for result in response.get_json())
+        return 0
+
+    def preview():
+        response = client.get(image_form(preview=True))
+        assert response.status_code == 200
+        return response.data.count(b'data:image/png;base64')
+
+    def job():
+        response = client.get(image_form(preview=False))
+        status_url = response.location + '/status'
+        while (state := client.get(status_url).get_json()['state']) not in ('done', 'failed'):
+            time.sleep(0.05)
+        assert state == 'done'
+        response = client.get(response.location + '/result')
+        return zip_frames(io.BytesIO(response.data))
+
+    return {'POST /': speed, 'POST /api/speed': api_speed, 'GET /image_preview': preview,
+            'image job': job}[case['pipeline']]
+
+
+RUNNERS = {'data_process': data_process_runner,
+           'image_process': image_runner,
+           'image_process_asi': image_runner}
+
+
+def run_case(case, inputs, repeats):
+    """Run one case in this (fresh) process and return its row of the table."""
+    scratch = tempfile.mkdtemp(prefix='etech-benchmark-')
+    # empty caches and workspaces of its own, set before the app modules read them on import
+    os.environ['RECORDING_CACHE_FOLDER'] = os.path.join(scratch, 'cache')
+    os.environ['RESULT_CACHE_PATH'] = os.path.join(scratch, 'cache', 'results.sqlite3')
+    os.environ['METRICS_FOLDER'] = os.path.join(scratch, 'metrics')
+    os.environ['WORKSPACE_FOLDER'] = os.path.join(scratch, 'workspaces')
+    import matplotlib
+    matplotlib.use('Agg')
+
+    try:
+        case = dict(case)
+        run = RUNNERS.get(case['pipeline'], flask_runner)(case, inputs, scratch)
+        base_rss = peak_rss_mb()
+
+        runtimes = []
+        for _ in range(1 + repeats):
+            start = time.perf_counter()
+            frames = run()
+            runtimes.append(time.perf_counter() - start)
+    finally:
+        # the job pool of the app is not shut down on its own, and this process cannot exit while it runs
+        jobs = sys.modules.get('jobs')
+        if jobs is not None and jobs.executor is not None:
+            jobs.executor.shutdown()
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    warm = np.median(runtimes[1:]) if repeats else np.nan
+    return dict(case,
+                cold_ms=runtimes[0] * 1000,
+                warm_ms=warm * 1000,
+                frames=frames,
+                fps=frames / np.median(runtimes) if frames else np.nan,
+                base_rss_mb=base_rss,
+                peak_rss_mb=peak_rss_mb())
+
+
+def benchmark(case_list, repeats=REPEATS):
+    folder = tempfile.mkdtemp(prefix='etech-inputs-')
+    try:
+        print('writing the synthetic inputs ...')
+        inputs = make_inputs(folder, {case['duration_s'] for case in case_list if 'duration_s' in case})
+
+        rows = []
+        # spawned, not forked, so nothing of the earlier cases is left in memory or in the caches
+        context = multiprocessing.get_context('spawn')
+        for case in case_list:
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                row = executor.submit(run_case, case, inputs, repeats).result()
+            print(', '.join(f'{key}={value:.4g}' if isinstance(value, float) else f'{key}={value}'
+                            for key, value in row.items()))
+            rows.append(row)
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+    columns = ['pipeline', 'duration_s', 'chunked', 'files', 'final_s', 'camerarate', 'cold_ms', 'warm_ms',
+               'frames', 'fps', 'base_rss_mb', 'peak_rss_mb']
+    return pd.DataFrame(rows).reindex(columns=columns)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeats', type=int, default=REPEATS, help='runs of every case after the first one')
+    parser.add_argument('--quick', action='store_true', help='only the shortest recording, final time and camera rate')
+    parser.add_argument('--output', default=OUTPUT)
+    args = parser.parse_args()
+
+    if args.quick:
+        case_list = list(cases(DURATIONS[:1], FINALS[:1], CAMERARATES[:1]))
+    else:
+        case_list = list(cases())
+
+    table = benchmark(case_list, repeats=args.repeats)
+    print(table.to_string(index=False))
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    table.to_csv(args.output, index=False, float_format='%.6g')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+"""Speed error and runtime of the speed trap timing methods on synthetic signals.
+
+Run from the repository root:
+
+    python -m benchmarks.speed_accuracy
+
+The table is printed and saved as csv, so the numbers can be compared between releases.
+"""
+import argparse
+import os
+import time
+import numpy as np
+import pandas as pd
+from scipy.signal import find_peaks
+import data_process
+from benchmarks.synthetic import speed_trap_signal
+
+
+FACTORS = [2, 5, 10, 15, 22.25, 30]
+# 16750 samples is what data_process looks at
+LENGTHS = [8000, 16750, 33500]
+SPEEDS = [30, 60, 100, 120]
+SAMPLE_RATE = 30008
+NOISE = 2.0
+# signals per length and speed, each with other noise and a different start within a sample
+TRIALS = 5
+
+OUTPUT = os.path.join(os.path.dirname(__file__), 'results', 'speed_accuracy.csv')
+
+
+def resampled_speed(resample):
+    # the speed calculation data_process used before trap_edges, with resample in place of resample_numpy
+    def speed(time_arr, speed_arr, factor):
+        resampled_time, resampled_arr = resample(time_arr, speed_arr, factor=factor)
+        peaks, _ = find_peaks(-abs(resampled_arr + 100), prominence=35)
+        if len(peaks) != 4:
+            return None
+        newsamplerate = len(resampled_time) / (resampled_time[-1] - resampled_time[0])
+        return newsamplerate*3600/1000/(peaks[2]-peaks[0])
+    return speed
+
+
+def edge_speed(time_arr, speed_arr, factor):
+    edges = data_process.trap_edges(time_arr, speed_arr)
+    if len(edges) != 4:
+        return None
+    return 3.6 / (edges[2] - edges[0])
+
+
+# name: (speed function, factors to run it with)
+METHODS = {'resample_numpy': (resampled_speed(data_process.resample_numpy), FACTORS),
+           'resample_signal': (resampled_speed(data_process.resample_signal), FACTORS),
+           'trap_edges': (edge_speed, [None])}
+
+
+def speed_accuracy(lengths=LENGTHS, speeds=SPEEDS, trials=TRIALS, sample_rate=SAMPLE_RATE, noise=NOISE):
+    rng = np.random.default_rng(0)
+    signals = {length: [] for length in lengths}
+    for length in lengths:
+        for speed in speeds:
+            for _ in range(trials):
+                start = .05 + rng.uniform(0, 1 / sample_rate)
+                time_arr, speed_arr = speed_trap_signal(speed, sample_rate, length, noise, start=start,
+                                                        seed=rng.integers(2**32))
+                signals[length].append((speed, time_arr, speed_arr))
+
+    rows = []
+    for name, (method, factors) in METHODS.items():
+        for factor in factors:
+            for length in lengths:
+                errors = []
+                runtimes = []
+                for true_speed, time_arr, speed_arr in signals[length]:
+                    start = time.perf_counter()
+                    speed = method(time_arr, speed_arr, factor)
+                    runtimes.append(time.perf_counter() - start)
+                    if speed is not None:
+                        errors.append(abs(speed - true_speed))
+
+                rows.append({'method': name,
+                             'factor': factor,
+                             'length': length,
+                             'signals': len(runtimes),
+                             'failed': len(runtimes) - len(errors),
+                             'mean_error_kmh': np.mean(errors) if errors else np.nan,
+                             'max_error_kmh': np.max(errors) if errors else np.nan,
+                             'median_ms': np.median(runtimes) * 1000})
+    return pd.DataFrame(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--trials', type=int, default=TRIALS)
+    parser.add_argument('--output', default=OUTPUT)
+    args = parser.parse_args()
+
+    table = speed_accuracy(trials=args.trials)
+    print(table.to_string(index=False))
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    table.to_csv(args.output, index=False, float_format='%.6g')
+
+
+if __name__ == '__main__':
+    main()
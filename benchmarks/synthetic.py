@@ -0,0 +1,162 @@
+"""Synthetic inputs in the formats of both pipelines, with known answers.
+
+speed_trap_signal is the speed sensor channel on its own. daq_recording writes a whole DAQ export for
+data_process, and image_inputs the X, Y, Z, RPY and ASI files for the image generator.
+"""
+import os
+import numpy as np
+
+
+# the speed sensor reads HIGH and drops to LOW while a pulse is on
+HIGH = 0
+LOW = -200
+
+# leading edges of the two pulses are TRAP_DISTANCE metres apart,
+# and each pulse lasts while the vehicle travels PULSE_LENGTH metres
+TRAP_DISTANCE = 1.0
+PULSE_LENGTH = 0.2
+
+
+def speed_trap_signal(speed_kmh, sample_rate=30008, length=16750, noise=2.0, rise_time=5e-5, start=0.05,
+                      seed=0):
+    """Return (time, signal) of the speed sensor channel for a vehicle passing at speed_kmh.
+
+    Each edge is a linear ramp rise_time seconds long, centered on the true edge time, so the
+    signal crosses the middle level exactly at the edge. start is the first leading edge in
+    seconds and noise the standard deviation of the gaussian noise added on top.
+    """
+    rng = np.random.default_rng(seed)
+    time = np.arange(length) / sample_rate
+    speed = speed_kmh / 3.6
+
+    signal = np.full(length, HIGH, dtype=np.float64)
+    for distance in (0, TRAP_DISTANCE):
+        on = start + distance / speed
+        off = on + PULSE_LENGTH / speed
+        # 0 outside the pulse and 1 inside it
+        pulse = np.clip((time - on) / rise_time + .5, 0, 1) * np.clip((off - time) / rise_time + .5, 0, 1)
+        signal += (LOW - HIGH) * pulse
+
+    signal += rng.normal(0, noise, length)
+    return time, signal
+
+
+# a DAQ export starts this long before the vehicle reaches the trap, like the recordings of the test rig
+PRE_ZERO = 0.5
+# (description, column name) of the channels of a DAQ export, in the order the rig writes them
+DAQ_CHANNELS = [('Speed Sensor', 'Chan 0:SPEED SENSOR'),
+                ('ARS1 Roll AR00207', 'Chan 1:353'),
+                ('ARS2 Pitch AR00208', 'Chan 2:354'),
+                ('ARS3 Yaw AR00209', 'Chan 3:355'),
+                ('Long Accel AC01011', 'Chan 4:351'),
+                ('Lat Accel AC01012', 'Chan 5:352'),
+                ('Vert Accel AC01013', 'Chan 6:356')]
+# roll, pitch and yaw rate sampling biases written into a DAQ export
+RATE_BIASES = (0.5, -0.3, 0.1)
+
+
+def daq_header(sample_rate, samples, test_id, sep):
+    # the 22 line header block, with the channel descriptions in row 8 where sort_columns looks for them
+    descriptions = [description for description, _ in DAQ_CHANNELS]
+    pre_zero = int(PRE_ZERO * sample_rate)
+    rows = [['Headers'] + [''] * 7,
+            ['Test Date'] + ['9/7/2022'] * 7,
+            ['Test Time'] + ['9:59:53 AM'] * 7,
+            ['Test ID'] + [test_id] * 7,
+            ['Test Description'] + ['synthetic'] * 7,
+            ['Sample Rate (Hz)'] + [str(sample_rate)] * 7,
+            ['Hardware AA Filter (-3dB)'] + ['6000'] * 7,
+            ['Data Channel Number'] + [str(i + 1) for i in range(7)],
+            ['ISO Channel Code'] + ['????????????????'] * 7,
+            ['Channel Description'] + descriptions,
+            ['Channel Location'] + ['NONE'] * 7,
+            ['Sensor S/N'] + [name.split(':')[1] for _, name in DAQ_CHANNELS],
+            ['Software Filter (SAE Class)'] + ['Other'] + ['180'] * 6,
+            ['Software Filter (-3dB)'] + ['0'] + ['300'] * 6,
+            ['Engineering Unit'] + ['V '] + ['deg/s '] * 3 + ['g '] * 3,
+            ['User Comment'] + [''] * 7,
+            ['Number of Pre-Zero Data Pts'] + [str(pre_zero)] * 7,
+            ['Number of Post-Zero Data Pts'] + [str(samples - pre_zero)] * 7,
+            ['Data Zero (CNTS)'] + ['0'] * 7,
+            ['Scale Factor (EU/CNT)'] + ['1'] * 7,
+            ['Scale Factor (mV/CNT)'] + ['1'] * 7,
+            ['Data Starts Here'] + [''] * 7,
+            ['Time'] + [name for _, name in DAQ_CHANNELS]]
+    return ''.join(sep.join(row) + '\n' for row in rows)
+
+
+def daq_recording(path, duration=10.5, sample_rate=30008, speed_kmh=100, sep='\t', test_id='SYN-001', seed=0,
+                  chunk_rows=100000):
+    """Write a DAQ export of duration seconds for data_process, and return path.
+
+    The vehicle passes the trap at speed_kmh just after time 0, and the roll, pitch and yaw rates are
+    noise around RATE_BIASES. Below about 80 km/h the second pulse ends after the samples data_process
+    looks at, like it would on the rig. sep is a tab like the rig writes, or a comma. The body is written
+    chunk_rows at a time, so long recordings do not have to fit in memory.
+    """
+    rng = np.random.default_rng(seed)
+    samples = int(duration * sample_rate)
+    start = PRE_ZERO + 0.002
+
+    with open(path, 'w', newline='') as f:
+        f.write(daq_header(sample_rate, samples, test_id, sep))
+        for first in range(0, samples, chunk_rows):
+            rows = min(chunk_rows, samples - first)
+            time = (first + np.arange(rows)) / sample_rate - PRE_ZERO
+            block = np.empty((rows, 8))
+            block[:, 0] = time
+            if first / sample_rate < start + 2 * TRAP_DISTANCE / (speed_kmh / 3.6):
+                _, speed = speed_trap_signal(speed_kmh, sample_rate, first + rows, start=start,
+                                             seed=rng.integers(2**32))
+                block[:, 1] = speed[first:]
+            else:
+                block[:, 1] = HIGH + rng.normal(0, 2.0, rows)
+            for column, bias in zip((2, 3, 4), RATE_BIASES):
+                block[:, column] = bias + rng.normal(0, 0.1, rows)
+            block[:, 5:8] = rng.normal(0, 0.05, (rows, 3))
+            np.savetxt(f, block, fmt='%.6f', delimiter=sep)
+    return path
+
+
+def impact_pulse(time, peak, width, onset=0.0):
+    # a half sine pulse of the given peak, width seconds long, starting at onset
+    phase = np.clip((time - onset) / width, 0, 1)
+    return peak * np.sin(np.pi * phase)
+
+
+def channel_file(path, columns, time, units):
+    """Write a channel file of the image generator: three lines of information, the column names, the units
+    and then the data, which read_channel_csv skips with skiprows=[0, 1, 2, 4]."""
+    with open(path, 'w', newline='') as f:
+        f.write('Synthetic crash test\nChannel export\n\n')
+        f.write(','.join(['Time'] + list(columns)) + '\n')
+        f.write(','.join(['s'] + list(units)) + '\n')
+        np.savetxt(f, np.column_stack([time] + [columns[name] for name in columns]), fmt='%.6f', delimiter=',')
+    return path
+
+
+def image_inputs(folder, duration=3.0, sample_rate=20000, seed=0):
+    """Write the X, Y and Z acceleration, RPY angle and ASI files of an impact into folder.
+
+    Returns {'x': path, 'y': path, 'z': path, 'rpy': path, 'asi': path}.
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(folder, exist_ok=True)
+    time = np.arange(int(duration * sample_rate)) / sample_rate
+
+    def noisy(signal, noise):
+        return signal + rng.normal(0, noise, len(time))
+
+    paths = {}
+    for name, peak in (('x', -25.0), ('y', 12.0), ('z', 4.0)):
+        paths[name] = channel_file(os.path.join(folder, f'{name}.csv'),
+                                   {'Raw': noisy(impact_pulse(time, peak, 0.12, 0.01), 1.0)}, time, ['g'])
+
+    angles = {'Roll Angle': np.cumsum(noisy(impact_pulse(time, 3.0, 0.3, 0.02), 0.01)) / sample_rate * 100,
+              'Pitch Angle': np.cumsum(noisy(impact_pulse(time, -2.0, 0.3, 0.02), 0.01)) / sample_rate * 100,
+              'Yaw Angle': np.cumsum(noisy(impact_pulse(time, 8.0, 0.4, 0.02), 0.01)) / sample_rate * 100}
+    paths['rpy'] = channel_file(os.path.join(folder, 'rpy.csv'), angles, time, ['deg'] * 3)
+
+    asi = np.abs(impact_pulse(time, 1.1, 0.15, 0.01)) + np.abs(rng.normal(0, 0.01, len(time)))
+    paths['asi'] = channel_file(os.path.join(folder, 'asi.csv'), {'ASI': asi}, time, [''])
+    return paths
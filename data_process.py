@@ -1,72 +1,140 @@
 import pandas as pd
 import numpy as np
-from scipy.signal import correlate,find_peaks
+from scipy.signal import correlate
 from matplotlib.figure import Figure
-from io import BytesIO
+from io import BytesIO, StringIO, TextIOWrapper
+from contextlib import contextmanager
 import base64
+import time
+import metrics
+import recording_cache
+import result_cache
+from signal_kernels import decimate_for_axes, masked_mean, masked_sum, minmax_indices, subtract_bias, window_mask
 
 
-def data_process(filename, starttime, endtime):
-    
-    try:
-        starttime = float(starttime)
-        endtime = float(endtime)
-    except:
-        starttime = 7
-        endtime = 9.8
-    
-    # output file with suffix added as well as a log file for storing speed calculation
-    outputfilename = filename.split('.csv')[0] + '_OFFSET'
+# number of lines in the header block of a DAQ export, including the line with the column names
+HEADER_LINES = 22
 
-    # read the csv file in first to just get the testID,sampleRate,and channel information
-    headerdata = pd.read_csv(filename, nrows=50)
+# in chunked mode the plots of the whole recording get about this many points of each channel
+PLOT_POINTS = 20000
 
-    # sometimes the file is tab seperated instead of comma seperated.
-    if headerdata.shape[1] < 7:
-        headerdata = pd.read_csv(filename, sep='\t', nrows=50)
+# number of samples at the start of the recording that hold the speed trap pulses
+SPEED_SAMPLES = 16750
 
-    # clean up
-    headerdata.dropna(axis=1, how='all', inplace=True)
-    header = headerdata.iloc[:21]
-    
-    # extract useful data
-    try:
-        testID = headerdata.iloc[2, 1]
-    except IndexError:
-        print('WARNING: the data file is not the correct type, style, or is corrupted.')
-        return {'speed_kmh': None,
-                'speed_falling': None,
-                'testID': None,
-                'imgdata': None,
-                'outputfilename': outputfilename,
-                'rollbias': None,
-                'pitchbias': None,
-                'yawbias': None,
-                'errorflag': 1
-                }
-    sampleRate = int(headerdata.iloc[4, 1])
-    channels = headerdata.iloc[8, 1:8]
-    
-    # read in the csv file again with only the meat of the data after the header section
-    data = pd.read_csv(filename, skiprows=22)
+# every edge of the speed trap pulses crosses this level. a crossing only counts once the
+# signal has been at least EDGE_BAND away from the level on both sides of it
+EDGE_LEVEL = -100
+EDGE_BAND = 35
+
+
+def read_header_block(f):
+    """Read the header block of an open DAQ export and return (delimiter, header dataframe).
+
+    The delimiter is sniffed from the first few KB, because the files are sometimes tab
+    separated instead of comma separated. f is left at the start of the body.
+    """
+    sample = f.read(4096)
+    sep = '\t' if sample.count('\t') > sample.count(',') else ','
+    f.seek(0)
 
-    # sometimes the file is tab seperated instead of comma seperated.
-    if data.shape[1] < 7:
-        data = pd.read_csv(filename, skiprows=22, sep='\t')
+    head = [f.readline() for _ in range(HEADER_LINES)]
 
-    # clean up
+    # the header block only holds text, keep it as it was written
+    headerdata = pd.read_csv(StringIO(''.join(head)), sep=sep, dtype=str)
+    return sep, headerdata.iloc[:, :8]
+
+
+@contextmanager
+def open_csv(filename):
+    """Open a DAQ export as text, from a path or from a binary file-like object such as an upload.
+
+    A file-like object is read from the start and is left open for whoever passed it in.
+    """
+    if not hasattr(filename, 'read'):
+        with open(filename, newline='') as f:
+            yield f
+        return
+
+    filename.seek(0)
+    f = TextIOWrapper(filename, newline='')
     try:
-        data.drop('Unnamed: 8', inplace=True, axis=1)
-    except KeyError:
-        print('WARNING: "Unnamed: 8" column not found in the data file. Proceeding...')
+        yield f
+    finally:
+        f.detach()
 
 
-    # sort the columns as needed to get them into the following order:
-    # X accel, Y accel, Z accel, Roll, Pitch, Yaw
+def read_daq_csv(filename):
+    """Read a DAQ export in one pass and return its header block and its numeric body.
+
+    The body is parsed once, as floats, and only the time column and the seven channels are kept.
+    """
+    with open_csv(filename) as f:
+        sep, headerdata = read_header_block(f)
+        data = pd.read_csv(f, sep=sep, usecols=range(8), dtype=np.float64)
+
+    return headerdata, data
+
+
+def header_meta(headerdata):
+    # the header block as it is kept in the recording cache
+    return {'header_columns': headerdata.columns.to_list(),
+            'header': headerdata.astype(object).where(headerdata.notna(), None).values.tolist()}
+
+
+def header_from_meta(meta):
+    return pd.DataFrame(meta['header'], columns=meta['header_columns'], dtype=object)
+
+
+def load_daq_csv(filename, key):
+    """Same as read_daq_csv, but parsed files are kept in the recording cache under key.
+
+    Re-running the same file with a different bias window skips the parsing completely.
+    """
+    cached = recording_cache.load(key)
+    if cached is not None:
+        meta, values = cached
+        headerdata = header_from_meta(meta)
+        return headerdata, pd.DataFrame(values, columns=meta['columns'])
+
+    headerdata, data = read_daq_csv(filename)
+    meta = dict(header_meta(headerdata), columns=data.columns.to_list())
+    recording_cache.store(key, meta, data.to_numpy())
+    return headerdata, data
+
+
+def open_daq_recording(filename, key, chunksize):
+    """Like load_daq_csv, for recordings too long to hold in memory.
+
+    A file that is not cached yet is parsed chunksize rows at a time straight into the
+    recording cache. Returns the header block, the column names and a read-only memory
+    map of the body, so only the rows that are actually used get loaded.
+    """
+    cached = recording_cache.load(key)
+
+    if cached is None:
+        with open_csv(filename) as f:
+            sep, headerdata = read_header_block(f)
+            meta = header_meta(headerdata)
+
+            def blocks():
+                for chunk in pd.read_csv(f, sep=sep, usecols=range(8), dtype=np.float64, chunksize=chunksize):
+                    meta['columns'] = chunk.columns.to_list()
+                    yield chunk.to_numpy()
+
+            cached = recording_cache.store_blocks(key, meta, blocks())
+
+    meta, values = cached
+    headerdata = header_from_meta(meta)
+    return headerdata, meta['columns'], values
+
+
+def sort_columns(headerdata, current_columns):
+    """Return the data and header column names in the following order:
+    Time, Speed, X accel, Y accel, Z accel, Roll, Pitch, Yaw
+    """
     channel_list = headerdata.iloc[8][1:] ## channel descriptions [0,4,5,6,1,2,3]
-    current_columns = data.columns.to_list()
-    cur_columns_header = header.columns.to_list()
-    
+    cur_columns_header = headerdata.columns.to_list()
+
     sortindex = []
     for channel in channel_list:
         if 'Speed' in channel:
@@ -83,70 +151,122 @@ def data_process(filename, starttime, endtime):
             sortindex.append(5)
         if 'Yaw' in channel:
             sortindex.append(6)
-        
+
     new_columns = ['Time']
     new_header_col = ['Headers']
     for x in range(7):
         new_columns.append(current_columns[1+sortindex[x]])
         new_header_col.append(cur_columns_header[1+sortindex[x]])
-        # print(x,new_columns,new_header_col)
-    
-    # use the new column list to reorder (reindex) the header dataframe and the data dataframe
-    data = data.reindex(columns=new_columns)
-    header = header.reindex(columns=new_header_col)
-
-    endd = 16750
-    time_arr = data['Time'].iloc[0:endd].to_numpy()
-    speed_arr = data['Chan 0:SPEED SENSOR'].iloc[0:endd].to_numpy()
-    factor = 22.25
-    # resampled_time, resampled_arr = resample_signal(time_arr, speed_arr, factor=factor)
-    resampled_time, resampled_arr = resample_numpy(time_arr, speed_arr, factor=factor)
-    
-    peaks, therest = find_peaks(-abs(resampled_arr+100), prominence=35)
 
-    if len(peaks) != 4:
-        print('WARNING: peaks were not found in the speed data, plotting raw speed, and canceling the operation.')
-        fig = Figure(figsize=(8, 5), dpi=75)
-        ax1 = fig.add_subplot(111)
+    return new_columns, new_header_col
+
+
+def format_csv_rows(block):
+    # one % template for the whole block. python's float repr gives the same text as
+    # DataFrame.to_csv, without going through the csv writer row by row
+    rows, cols = block.shape
+    return (('%r,' * (cols - 1) + '%r\n') * rows) % tuple(block.ravel().tolist())
+
+
+def offset_csv(recording, rollbias, pitchbias, yawbias, chunksize=10000):
+    """Return a generator of the bias corrected recording as csv text, chunksize rows at a time.
+
+    recording is the recording cache key of the recording, or its parsed (meta, values) as
+    data_process returns them with keep_data. Nothing is written to disk. Returns None if the
+    recording is given by its key and is no longer in the cache.
+    """
+    cached = recording_cache.load(recording) if isinstance(recording, str) else recording
+    if cached is None:
+        return None
 
-        ax1.plot(data['Time'].to_numpy(), data['Chan 0:SPEED SENSOR'].to_numpy())
+    meta, values = cached
+    headerdata = header_from_meta(meta)
+    new_columns, new_header_col = sort_columns(headerdata, meta['columns'])
+    header = headerdata.iloc[:21].reindex(columns=new_header_col)
+    order = [meta['columns'].index(column) for column in new_columns]
+    biases = np.array([rollbias, pitchbias, yawbias], dtype=np.float64)
 
-        ax1.grid()
-        ax1.set_title('Speed Signal')
-        ax1.set_xlabel('Time (s)')
-        ax1.set_ylabel('Speed Sensor')
+    def generate():
+        yield header.to_csv(index=False, header=['Headers', '', '', '', '', '', '', ''])
+        yield pd.DataFrame(columns=new_columns).to_csv(index=False)
 
-        buf = BytesIO()
+        # only the time spent making the csv counts, not the time the caller takes with each piece
+        elapsed = 0
+        for start in range(0, len(values), chunksize):
+            started = time.perf_counter()
+            # subract sampling bias from roll, pitch and yaw
+            block = values[start:start + chunksize][:, order]
+            subtract_bias(block, biases, slice(5, 8))
+            rows = format_csv_rows(block)
+            elapsed += time.perf_counter() - started
+            yield rows
+        metrics.record_stage('speed.offset_csv', elapsed)
+
+    return generate()
+
+
+def trap_edges(time_arr, speed_arr, level=EDGE_LEVEL, band=EDGE_BAND):
+    """Return the times at which the speed trap signal crosses level, to a fraction of a sample.
+
+    Samples further than band above or below level decide which side of it the signal is on.
+    Each time the side changes, the first crossing in between is placed by linear interpolation
+    between the two samples around it. This is the point that resampling the signal with np.interp
+    and picking the sample closest to level converges to, without building the resampled arrays.
+    """
+    offset = speed_arr - level
+    side = np.zeros(len(offset), dtype=np.int8)
+    side[offset > band] = 1
+    side[offset < -band] = -1
+
+    settled = np.flatnonzero(side)
+    edges = []
+    for i in np.flatnonzero(np.diff(side[settled])):
+        start, stop = settled[i], settled[i + 1]
+        segment = np.sign(offset[start:stop + 1])
+        j = start + np.flatnonzero(segment[:-1] != segment[1:])[0]
+        fraction = offset[j] / (offset[j] - offset[j + 1])
+        edges.append(time_arr[j] + fraction * (time_arr[j + 1] - time_arr[j]))
+    return np.array(edges)
+
+
+def figure_png(fig):
+    buf = BytesIO()
+    with metrics.stage('speed.savefig'):
         fig.savefig(buf, format="png")
-        # Embed the result in the html output.
-        imgdata = base64.b64encode(buf.getbuffer()).decode("ascii")
+    # Embed the result in the html output.
+    with metrics.stage('speed.base64'):
+        return base64.b64encode(buf.getbuffer()).decode("ascii")
 
-        return {'speed_kmh': None,
-                'speed_falling': None,
-                'testID': testID,
-                'imgdata': imgdata,
-                'outputfilename': outputfilename,
-                'rollbias': None,
-                'pitchbias': None,
-                'yawbias': None,
-                'errorflag': 1
-                }
 
-    newsamplerate = len(resampled_time) / (resampled_time[-1] - resampled_time[0])
-    speed_leading = newsamplerate*3600/1000/(peaks[2]-peaks[0])
-    speed_falling = newsamplerate*3600/1000/(peaks[3]-peaks[1])
-    offset = 3.6 / speed_leading
+def raw_speed_figure(data):
+    # when the edges are not found, the whole speed signal is shown instead
+    fig = Figure(figsize=(8, 5), dpi=75)
+    ax1 = fig.add_subplot(111)
+
+    ax1.plot(*decimate_for_axes(ax1, data['Time'], data['Chan 0:SPEED SENSOR']))
+
+    ax1.grid()
+    ax1.set_title('Speed Signal')
+    ax1.set_xlabel('Time (s)')
+    ax1.set_ylabel('Speed Sensor')
+
+    return figure_png(fig)
 
-    xlim_param = resampled_time[peaks[0]] - 0.00105
 
-    # plot raw speed sensor data for user to confirm nothing is fishy
+def speed_figure(time_arr, speed_arr, edges, speed_leading, data, starttime, endtime):
+    xlim_param = edges[0] - 0.00105
+    xlim1 = (xlim_param, xlim_param+.01)
+    xlim3 = (edges[0]-.008, edges[-1]+.008)
+
+    # plot raw speed sensor data for user to confirm nothing is fishy.
+    # every line only gets the samples that show at the width of its axes
     fig = Figure(figsize=(8, 13), dpi=75)
     ax1 = fig.add_subplot(311)
     
-    ax1.plot(time_arr, speed_arr, '^:', label='original')
-    ax1.plot(time_arr-offset, speed_arr, '>:', label='shifted')
+    ax1.plot(*decimate_for_axes(ax1, time_arr, speed_arr, xlim1), '^:', label='original')
+    ax1.plot(*decimate_for_axes(ax1, time_arr-(edges[2]-edges[0]), speed_arr, xlim1), '>:', label='shifted')
 
-    ax1.set_xlim(xlim_param, xlim_param+.01)
+    ax1.set_xlim(xlim1)
     ax1.legend()
     ax1.grid()
     ax1.set_title(f'speed = {round(speed_leading,2)} kmh')
@@ -155,9 +275,9 @@ def data_process(filename, starttime, endtime):
 
     ax2 = fig.add_subplot(313)
     
-    ax2.plot(data['Time'], data.iloc[:, 5], label='Roll')
-    ax2.plot(data['Time'], data.iloc[:, 6], label='Pitch')
-    ax2.plot(data['Time'], data.iloc[:, 7], label='Yaw')
+    ax2.plot(*decimate_for_axes(ax2, data['Time'], data.iloc[:, 5]), label='Roll')
+    ax2.plot(*decimate_for_axes(ax2, data['Time'], data.iloc[:, 6]), label='Pitch')
+    ax2.plot(*decimate_for_axes(ax2, data['Time'], data.iloc[:, 7]), label='Yaw')
     
     ylimits = ax2.get_ylim()
     ax2.plot([starttime]*2, ylimits, 'k:')
@@ -171,49 +291,219 @@ def data_process(filename, starttime, endtime):
 
     ax3 = fig.add_subplot(312)
 
-    ax3.plot(resampled_time, -abs(resampled_arr + 100), label='-abs(s+100)')
-    ax3.plot(resampled_time[peaks], -abs(resampled_arr + 100)[peaks], '*', markersize=10, label='peaks')
+    ax3.plot(*decimate_for_axes(ax3, time_arr, -abs(speed_arr - EDGE_LEVEL), xlim3), '.-', label='-abs(s+100)')
+    ax3.plot(edges, np.zeros(len(edges)), '*', markersize=10, label='edges')
 
-    ax3.set_xlim(min(resampled_time[peaks])-.008, max(resampled_time[peaks])+.008)
+    ax3.set_xlim(xlim3)
     ax3.set_ylabel('-abs(speed+100)')
     ax3.set_xlabel('Time (s)')
     ax3.legend()
     ax3.grid()
 
-    buf = BytesIO()
-    fig.savefig(buf, format="png")
-    # Embed the result in the html output.
-    imgdata = base64.b64encode(buf.getbuffer()).decode("ascii")
-    
-    datasubset = data[(data['Time'] >= starttime) & (data['Time'] <= endtime)]
-    
-    # take a mean (average) of the three vectors
-    rollbias = datasubset.iloc[:, 5].mean()
-    pitchbias = datasubset.iloc[:, 6].mean()
-    yawbias = datasubset.iloc[:, 7].mean()
-    
-    # copy of the data is required so that it can be modified
-    offsetdata = data.copy()
-    
-    # subract sampling bias from data
-    offsetdata.iloc[:, 5] = offsetdata.iloc[:, 5] - rollbias
-    offsetdata.iloc[:, 6] = offsetdata.iloc[:, 6] - pitchbias
-    offsetdata.iloc[:, 7] = offsetdata.iloc[:, 7] - yawbias
+    return figure_png(fig)
+
+
+def data_process(filename, starttime, endtime, chunksize=None, plot=True, keep_data=False):
+    # filename is a path, a binary file-like object (an upload that never touches the disk) or bytes.
+    # with keep_data a successful result also has the parsed recording as data, for offset_csv, so the
+    # caller does not depend on it still being in the recording cache. it is never put in the result cache
+    filename = recording_cache.as_source(filename)
+
+    try:
+        starttime = float(starttime)
+        endtime = float(endtime)
+    except:
+        starttime = 7
+        endtime = 9.8
     
-    # data.to_csv("output.csv")
-    header.to_csv(outputfilename+'.csv', index=False, header=['Headers', '', '', '', '', '', '', ''])
-    offsetdata.to_csv(outputfilename+'.csv', index=False, mode='a')
-
-    return {'speed_kmh': speed_leading,
-            'speed_falling': speed_falling,
-            'testID': testID,
-            'imgdata': imgdata,
-            'outputfilename': outputfilename,
-            'rollbias': rollbias,
-            'pitchbias': pitchbias,
-            'yawbias': yawbias,
-            'errorflag': 0
-            }
+    # name for the bias corrected output file
+    outputfilename = recording_cache.source_name(filename).split('.csv')[0] + '_OFFSET'
+
+    # the parsed data is kept in the recording cache under this key. offset_csv serves
+    # the bias corrected data from there, so no output file is written here
+    recording = recording_cache.cache_key(filename, 'daq')
+
+    # the same file with the same bias window gives the same result. it is only reused while the
+    # recording is still cached, because /getCSV needs it
+    resultkey = result_cache.result_key(recording, starttime, endtime)
+    cached = result_cache.get(resultkey)
+    loaded = recording_cache.load(recording) if cached is not None else None
+    if cached is not None and (cached['imgdata'] is not None or not plot) and loaded is not None:
+        metrics.count('result_cache_total', result='hit')
+        metrics.count('speed_results_total', errorflag=cached['errorflag'])
+        if keep_data:
+            return dict(cached, outputfilename=outputfilename, data=loaded)
+        return dict(cached, outputfilename=outputfilename)
+    metrics.count('result_cache_total', result='miss')
+
+    # read the header block (testID, sampleRate, and channel information) and the data in one go.
+    # with a chunksize the data stays on disk and is only read chunksize rows at a time
+    try:
+        with metrics.stage('speed.parse'):
+            if chunksize is None:
+                headerdata, data = load_daq_csv(filename, recording)
+                current_columns = data.columns.to_list()
+            else:
+                headerdata, current_columns, values = open_daq_recording(filename, recording, chunksize)
+        testID = headerdata.iloc[2, 1]
+    except (IndexError, ValueError):
+        print('WARNING: the data file is not the correct type, style, or is corrupted.')
+        metrics.count('speed_results_total', errorflag=1)
+        return {'speed_kmh': None,
+                'speed_falling': None,
+                'testID': None,
+                'imgdata': None,
+                'outputfilename': outputfilename,
+                'recording': None,
+                'rollbias': None,
+                'pitchbias': None,
+                'yawbias': None,
+                'errorflag': 1
+                }
+    sampleRate = int(headerdata.iloc[4, 1])
+    channels = headerdata.iloc[8, 1:8]
+
+    # sort the columns as needed to get them into the following order:
+    # X accel, Y accel, Z accel, Roll, Pitch, Yaw
+    new_columns, new_header_col = sort_columns(headerdata, current_columns)
+
+    # the recording as offset_csv takes it
+    parsed = (dict(header_meta(headerdata), columns=current_columns),
+              data.to_numpy() if chunksize is None else values)
+
+    endd = SPEED_SAMPLES
+    if chunksize is None:
+        data = data.reindex(columns=new_columns)
+        headdata = data.iloc[0:endd]
+    else:
+        # only keep the rows needed for the speed calculation in memory, and for the plots the rows
+        # with the smallest and largest value of each plotted channel in about PLOT_POINTS / 2 runs
+        # of the recording, so its spikes still show. the memory map is read a chunk at a time
+        order = [current_columns.index(column) for column in new_columns]
+        headdata = pd.DataFrame(values[0:endd][:, order], columns=new_columns)
+        buckets = max(1, PLOT_POINTS // 2 * chunksize // max(len(values), 1))
+        rows = [np.arange(0)]
+        if plot:
+            with metrics.stage('speed.decimate'):
+                for start in range(0, len(values), chunksize):
+                    chunk = values[start:start + chunksize]
+                    rows += [start + minmax_indices(chunk[:, column], buckets) for column in [order[1]] + order[5:8]]
+        data = pd.DataFrame(values[np.unique(np.concatenate(rows))][:, order], columns=new_columns)
+
+    time_arr = headdata['Time'].to_numpy()
+    speed_arr = headdata['Chan 0:SPEED SENSOR'].to_numpy()
+    # the leading and falling edges of the two pulses
+    with metrics.stage('speed.edges'):
+        edges = trap_edges(time_arr, speed_arr)
+
+    if len(edges) != 4:
+        print('WARNING: peaks were not found in the speed data, plotting raw speed, and canceling the operation.')
+        metrics.count('speed_results_total', errorflag=1)
+        imgdata = None
+        if plot:
+            with metrics.stage('speed.plot'):
+                imgdata = raw_speed_figure(data)
+
+        result = {'speed_kmh': None,
+                  'speed_falling': None,
+                  'testID': testID,
+                  'imgdata': imgdata,
+                  'outputfilename': outputfilename,
+                  'recording': recording,
+                  'rollbias': None,
+                  'pitchbias': None,
+                  'yawbias': None,
+                  'errorflag': 1
+                  }
+        # kept like any other result, so the result page can show the plot of the raw speed
+        result_cache.put(resultkey, result)
+        return result
+
+    # the pulses are 1 m apart, so the speed in km/h is 3.6 / (seconds between them)
+    offset = edges[2] - edges[0]
+    speed_leading = 3.6 / offset
+    speed_falling = 3.6 / (edges[3] - edges[1])
+
+    imgdata = None
+    if plot:
+        with metrics.stage('speed.plot'):
+            imgdata = speed_figure(time_arr, speed_arr, edges, speed_leading, data, starttime, endtime)
+
+    with metrics.stage('speed.bias'):
+        if chunksize is None:
+            inwindow = window_mask(data['Time'].to_numpy(), starttime, endtime)
+
+            # take a mean (average) of the three vectors
+            rollbias, pitchbias, yawbias = masked_mean(data.iloc[:, 5:8].to_numpy(), inwindow)
+
+        else:
+            # one pass over the recording for the means of roll, pitch and yaw in the bias window.
+            # the memory map is read a chunk at a time
+            rpy = order[5:8]
+            total = np.zeros(3)
+            count = np.zeros(3)
+            for start in range(0, len(values), chunksize):
+                chunk = values[start:start + chunksize]
+                sums, counts = masked_sum(chunk[:, rpy], window_mask(chunk[:, order[0]], starttime, endtime))
+                total += sums
+                count += counts
+            with np.errstate(invalid='ignore', divide='ignore'):
+                rollbias, pitchbias, yawbias = total / count
+
+    result = {'speed_kmh': float(speed_leading),
+              'speed_falling': float(speed_falling),
+              'testID': testID,
+              'imgdata': imgdata,
+              'outputfilename': outputfilename,
+              'recording': recording,
+              'rollbias': float(rollbias),
+              'pitchbias': float(pitchbias),
+              'yawbias': float(yawbias),
+              'errorflag': 0
+              }
+    metrics.count('speed_results_total', errorflag=0)
+    result_cache.put(resultkey, result)
+    if keep_data:
+        return dict(result, data=parsed)
+    return result
+
+
+def decimated_series(time_arr, value_arr, points):
+    # the samples that matter when the signal is drawn points pixels wide, as json friendly lists
+    keep = minmax_indices(value_arr, max(1, points // 2))
+    return {'time': time_arr[keep].tolist(), 'value': value_arr[keep].tolist()}
+
+
+def speed_series(recording, points=1000):
+    """Return the signals of the speed result plots of a cached recording, decimated for drawing them
+    points pixels wide, or None if the recording is no longer in the cache.
+
+    The speed trap signal is cut to the pulses, like the server side plot. If the edges are not
+    found, edges is empty and the whole speed signal is sent instead.
+    """
+    cached = recording_cache.load(recording)
+    if cached is None:
+        return None
+
+    meta, values = cached
+    new_columns, _ = sort_columns(header_from_meta(meta), meta['columns'])
+    order = [meta['columns'].index(column) for column in new_columns]
+
+    time_arr = np.asarray(values[:, order[0]])
+    edges = trap_edges(time_arr[:SPEED_SAMPLES], np.asarray(values[:SPEED_SAMPLES, order[1]]))
+
+    if len(edges) == 4:
+        pulses = slice(*np.searchsorted(time_arr[:SPEED_SAMPLES], [edges[0] - .008, edges[-1] + .008]))
+    else:
+        edges = []
+        pulses = slice(None)
+
+    series = {'level': EDGE_LEVEL,
+              'edges': list(map(float, edges)),
+              'speed': decimated_series(time_arr[pulses], np.asarray(values[pulses, order[1]]), points)}
+    for name, column in zip(('roll', 'pitch', 'yaw'), order[5:8]):
+        series[name] = decimated_series(time_arr, np.asarray(values[:, column]), points)
+    return series
 
 
 def resample_numpy(t_arr, x_arr, factor=2):
@@ -224,11 +514,10 @@ def resample_numpy(t_arr, x_arr, factor=2):
 def resample_signal(t_arr, x_arr, factor=2):
 
     length = len(t_arr)
-    idx = pd.date_range("2018-01-01", periods=length, freq="H")
+    idx = pd.date_range("2018-01-01", periods=length, freq="h")
     ts = pd.DataFrame(pd.Series(t_arr, index=idx, name='time'))
     ts['signal'] = x_arr
     
     minutes = 60/factor
-    resampled = ts.resample(f'{int(minutes)}Min').first().interpolate(method='polynomial', order=1)
-    print('len ration', len(t_arr), len(resampled['time'].to_numpy()))
+    resampled = ts.resample(f'{int(minutes)}min').first().interpolate(method='polynomial', order=1)
     return resampled['time'].to_numpy(), resampled['signal'].to_numpy()
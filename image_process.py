@@ -1,100 +1,230 @@
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
 from io import BytesIO
 import base64
 import os
 import shutil
+import threading
 import time
+import zipfile
+from PIL import Image
+import metrics
+import recording_cache
+from signal_kernels import centered_moving_average, decimate_for_axes, minmax_indices, value_range
+
+
+# one output image. pre-impact frames have no sample and count down to impact instead
+Frame = namedtuple('Frame', ['number', 'sample', 'countdown'])
+
+# the accelerations are smoothed with a centered moving average this many seconds wide
+SMOOTHING_WINDOW = .010
+
+# 30x8 inches at 64 dpi gives 1920x512 images
+FIGSIZE = (30, 8)
+DPI = 64
+
+# how the frames are encoded: file extension, pillow format and pillow save options.
+# 'png' uses the same zlib level as plt.savefig. 'raw' keeps the RGBA bytes of the canvas as they are.
+FRAME_ENCODINGS = {
+    'png': ('png', 'PNG', {'compress_level': 6}),
+    'png-fast': ('png', 'PNG', {'compress_level': 1}),
+    'png-max': ('png', 'PNG', {'compress_level': 9, 'optimize': True}),
+    'jpeg': ('jpg', 'JPEG', {'quality': 90}),
+    'raw': ('rgba', None, {}),
+}
+
+
+def read_channel_csv(filename, usecols=None, until=None):
+    """Read up to 2-3 seconds of a channel file, or stop once Time reaches until.
+
+    The files start with three lines of information, then the column names and a line
+    of units. final is usually a small fraction of the recording, so parsing stops at the
+    first chunk of rows that gets there. What has been parsed goes to the recording cache
+    and is reused as long as it reaches far enough.
+    """
+    filename = recording_cache.as_source(filename)
+    key = recording_cache.cache_key(filename, 'channel', 'all' if usecols is None else len(usecols))
+    cached = recording_cache.load(key)
+    if cached is not None:
+        meta, values = cached
+        df = pd.DataFrame(values, columns=meta['columns'])
+        if meta['complete'] or (until is not None and df.Time.iloc[-1] >= until):
+            return df
+
+    chunks = []
+    complete = True
+    with pd.read_csv(filename, skiprows=[0, 1, 2, 4], usecols=usecols, nrows=60000, chunksize=2000) as reader:
+        for chunk in reader:
+            chunks.append(chunk)
+            if until is not None and chunk.Time.iloc[-1] >= until:
+                complete = False
+                break
+    df = pd.concat(chunks, ignore_index=True)
+
+    try:
+        values = df.to_numpy(dtype=np.float64)
+    except (TypeError, ValueError):
+        # not numbers. leave it to the caller to complain about it
+        return df
+    recording_cache.store(key, {'columns': df.columns.to_list(), 'complete': complete}, values)
+    return df
 
 
 def tweak_xyz(dfx, dfy, dfz, final):
-    def tweak(df):
-        return (df
-                .assign(Average=df
-                        .Raw
-                        .rolling(wind, center=True, min_periods=1)
-                        .mean()
-                        )
-                .Average)
-
-    dt = dfx.Time[1] - dfx.Time[0]
-    wind = int(.010 // dt)
-    return (pd.concat([dfx.Time, tweak(dfx), tweak(dfy), tweak(dfz)],
-                      axis=1,
-                      keys=['Time', 'X', 'Y', 'Z'])
-            .query(f'Time < {final}'))
-
-
-def image_process(x, y, z, rpy, oiv, final, camerarate):
-    
+    """Smooth the X, Y and Z accelerations together and return (time, xyz) before the final time.
+
+    xyz is a (samples x 3) array. The files are cut to the shortest one, which averages the
+    same samples as the moving average skipping the missing ones would.
+    """
+    n = min(len(dfx), len(dfy), len(dfz))
+    timedata = dfx.Time.to_numpy(dtype=np.float64)[:n]
+    raw = np.column_stack([df.Raw.to_numpy(dtype=np.float64)[:n] for df in (dfx, dfy, dfz)])
+
+    dt = timedata[1] - timedata[0]
+    wind = int(SMOOTHING_WINDOW // dt)
+    xyz = centered_moving_average(raw, wind)
+
+    keep = timedata < final
+    return timedata[keep], xyz[keep]
+
+
+def load_channels(final, x, y, z, rpy, asi=None):
+    """Read the channel files concurrently and return their columns as numpy arrays, up to final.
+
+    Most of the time goes to waiting on the files and to the C parser, which both let go of the GIL,
+    so threads are enough. Raises ValueError naming the file if any of them cannot be used.
+    The files can be paths, binary file-like objects or bytes, like the uploads of a request.
+    """
+    x, y, z, rpy, asi = [recording_cache.as_source(source) for source in (x, y, z, rpy, asi)]
+    # the moving average at the final time still needs half a window of samples after it
+    files = {'X': (x, [0, 1], final + SMOOTHING_WINDOW / 2),
+             'Y': (y, [0, 1], final + SMOOTHING_WINDOW / 2),
+             'Z': (z, [0, 1], final + SMOOTHING_WINDOW / 2),
+             'RPY': (rpy, None, final)}
+    if asi is not None:
+        files['ASI'] = (asi, None, final)
+
+    with metrics.stage('images.read'), ThreadPoolExecutor(max_workers=len(files)) as executor:
+        futures = {name: executor.submit(read_channel_csv, filename, usecols=usecols, until=until)
+                   for name, (filename, usecols, until) in files.items()}
+        # wait for all of them before complaining, so no reader is left running
+        errors = {name: future.exception() for name, future in futures.items()}
+
+    frames = {}
+    for name, (filename, usecols, until) in files.items():
+        if errors[name] is not None:
+            raise ValueError(f'could not read the {name} file {os.path.basename(recording_cache.source_name(filename))} ({errors[name]})')
+        frames[name] = futures[name].result()
+
+    def column(name, label):
+        df = frames[name]
+        try:
+            values = df[label].to_numpy(dtype=np.float64)[df['Time'].to_numpy(dtype=np.float64) < final]
+        except (KeyError, TypeError, ValueError):
+            raise ValueError(f'the {name} file {os.path.basename(recording_cache.source_name(files[name][0]))} has no numeric '
+                             f'Time and {label} columns')
+        return values
+
+    samples = {name: len(column(name, 'Raw')) for name in ('X', 'Y', 'Z')}
+    for name in ('Y', 'Z'):
+        if samples[name] != samples['X']:
+            raise ValueError(f'the {name} file {os.path.basename(recording_cache.source_name(files[name][0]))} has {samples[name]} '
+                             f'samples before the final time where the X file has {samples["X"]}')
     try:
-        oiv = float(oiv)
-        final = float(final)
-        camerarate = float(camerarate)
-    except ValueError:
-        print('WARNING: oiv, final, or camerarate could not be cast as a floating point number')
-        return False
+        with metrics.stage('images.smooth'):
+            timedata, xyz = tweak_xyz(frames['X'], frames['Y'], frames['Z'], final)
+    except (AttributeError, IndexError, KeyError, TypeError, ValueError):
+        raise ValueError('the X, Y and Z files are not in the correct format, or they are corrupted')
+
+    data = {'Time': timedata,
+            'X': xyz[:, 0],
+            'Y': xyz[:, 1],
+            'Z': xyz[:, 2],
+            'Roll': column('RPY', 'Roll Angle'),
+            'Pitch': column('RPY', 'Pitch Angle'),
+            'Yaw': column('RPY', 'Yaw Angle')}
+    if asi is not None:
+        data['ASI'] = column('ASI', 'ASI')
+
+    # every channel is plotted against the same time axis
+    for name, values in data.items():
+        if len(values) != len(data['Time']):
+            source = 'RPY' if name in ('Roll', 'Pitch', 'Yaw') else name
+            raise ValueError(f'the {source} file {os.path.basename(recording_cache.source_name(files[source][0]))} has {len(values)} '
+                             f'samples before the final time where the X file has {len(data["Time"])}')
+        if len(values) < 2:
+            raise ValueError(f'there are fewer than 2 samples before the final time in the {name} data')
+    return data
+
+
+def frame_plan(timedata, final, camerarate, step=1):
+    # for the 10 frames before impact,
+    # these plots will not 'move' but the text in the title should update each time
+    frames = {i + 1: Frame(i + 1, None, i - 10) for i in range(10)}
+
+    dt = timedata[1] - timedata[0]
+    samples_per_sec = 1 / dt
+    increment = samples_per_sec / camerarate
+    num_images = int(final / dt // increment)
 
+    # the first frame after impact reuses number 10 and replaces the last pre-impact frame
+    for ind in range(num_images):
+        frames[ind + 10] = Frame(ind + 10, int(ind * increment), None)
 
-    labelfontsize = 14
-    titlefontsize = 20
+    # a preview only renders every step-th frame
+    return list(frames.values())[::step]
 
-    if not os.path.exists(os.path.join(os.path.dirname(x), 'generated_images')):
-        os.makedirs(os.path.join(os.path.dirname(x), 'generated_images'))
 
-    my_directory = os.path.join(os.path.dirname(x), 'generated_images')
+# free templates kept in each process for every layout and dpi, see figure_template
+TEMPLATE_POOL_SIZE = 2
 
-    # read in 2-3 seconds of data and then query it to the final time
-    try:
-        dfx = pd.read_csv(x, skiprows=[0, 1, 2, 4], usecols=[0, 1], nrows=60000)
-        dfy = pd.read_csv(y, skiprows=[0, 1, 2, 4], usecols=[0, 1], nrows=60000)
-        dfz = pd.read_csv(z, skiprows=[0, 1, 2, 4], usecols=[0, 1], nrows=60000)
-        dfRPY = pd.read_csv(rpy, skiprows=[0, 1, 2, 4], nrows=60000).query(f'Time < {final}')
-    except:
-        print('WARNING: something went wrong while reading input '
-              'files. Double check that you are uploading the correct files.')
-        return False
+# one figure layout, built once. fill(data, oiv, final) puts the data of a job in it and returns (lines, titles)
+FigureTemplate = namedtuple('FigureTemplate', ['fig', 'fill'])
 
-    try:
-        xyz = tweak_xyz(dfx, dfy, dfz, final)
-    except AttributeError:
-        print('WARNING: input files are not in the correct format, or they are corrupted. Cancelling the operation.')
-        return False
 
-    # separate the columns into numpy arrays
-    timedata = xyz.Time.to_numpy()
-    Xaccel_Avg = xyz.X.to_numpy()
-    Yaccel_Avg = xyz.Y.to_numpy()
-    Zaccel_Avg = xyz.Z.to_numpy()
-    Rolldata = dfRPY['Roll Angle'].to_numpy()
-    Pitchdata = dfRPY['Pitch Angle'].to_numpy()
-    Yawdata = dfRPY['Yaw Angle'].to_numpy()
+def new_figure(dpi):
+    # a plain Figure on its own Agg canvas. pyplot never sees it, so nothing global keeps it alive
+    # and different threads can draw different figures at the same time
+    fig = Figure(figsize=FIGSIZE, dpi=dpi)  # gives 512*1920 images
+    FigureCanvasAgg(fig)
+    axes = fig.subplots(2, 2, sharex=True)
+    # the layout comes first, so the traces can be decimated to the final width of their axes
+    fig.subplots_adjust(wspace=0.1)
+    return fig, axes
 
-    # plotting
-    fig, ((ax1, ax2), (ax3, ax4)) = plt.subplots(2, 2, sharex=True, figsize=(30, 8), dpi=64) #gives 512*1920 images
 
-    ax1.plot([oiv, oiv], [min(Xaccel_Avg) - 4, max(Xaccel_Avg) + 4], 'r--', lw=1, label='Time of OIV')  # plot OIV
-    ax1.plot(timedata, Xaccel_Avg, 'b:', lw=.6)  # plot all the X data with a light dotted line
-    line1, = ax1.plot(timedata[0:0], Xaccel_Avg[0:0], 'b-', lw=2)
+def mash_figure(dpi=DPI):
+    labelfontsize = 14
+    titlefontsize = 20
 
-    ax2.plot(timedata, Yaccel_Avg, 'b:', lw=.6)  # plot all the X data with a light dotted line
-    line2, = ax2.plot(timedata[0:0], Yaccel_Avg[0:0], 'b-', lw=2)  # st
+    fig, ((ax1, ax2), (ax3, ax4)) = new_figure(dpi)
 
-    ax3.plot(timedata, Zaccel_Avg, 'b:', lw=.6)  # plot all the Z data with a light dotted line
-    line3, = ax3.plot(timedata[0:0], Zaccel_Avg[0:0], 'b-', lw=2)  #
+    oivline, = ax1.plot([], [], 'r--', lw=1, label='Time of OIV')  # plot OIV
+    trace1, = ax1.plot([], [], 'b:', lw=.6)  # plot all the X data with a light dotted line
+    line1, = ax1.plot([], [], 'b-', lw=2)
 
-    ax4.plot(timedata, Rolldata, 'b:', lw=.6)  # plot all the Roll data with a light dotted line
-    line4, = ax4.plot(timedata[0:0], Rolldata[0:0], 'b-', lw=2, label='Roll')
+    trace2, = ax2.plot([], [], 'b:', lw=.6)  # plot all the Y data with a light dotted line
+    line2, = ax2.plot([], [], 'b-', lw=2)
 
-    ax4.plot(timedata, Pitchdata, 'r:', lw=.6)  # plot all the Pitch data with a light dotted line
-    line5, = ax4.plot(timedata[0:0], Pitchdata[0:0], 'r-', lw=2, label='Pitch')
+    trace3, = ax3.plot([], [], 'b:', lw=.6)  # plot all the Z data with a light dotted line
+    line3, = ax3.plot([], [], 'b-', lw=2)
 
-    ax4.plot(timedata, Yawdata, 'k:', lw=.6)  # plot all the Pitch data with a light dotted line
-    line6, = ax4.plot(timedata[0:0], Yawdata[0:0], 'k-', lw=2, label='Yaw')
+    trace4, = ax4.plot([], [], 'b:', lw=.6)  # plot all the Roll data with a light dotted line
+    line4, = ax4.plot([], [], 'b-', lw=2, label='Roll')
+
+    trace5, = ax4.plot([], [], 'r:', lw=.6)  # plot all the Pitch data with a light dotted line
+    line5, = ax4.plot([], [], 'r-', lw=2, label='Pitch')
+
+    trace6, = ax4.plot([], [], 'k:', lw=.6)  # plot all the Yaw data with a light dotted line
+    line6, = ax4.plot([], [], 'k-', lw=2, label='Yaw')
 
     ax1.legend()  # legend on ax1 for OIV
-    ax4.legend()  # legend on ax3 for Roll and Pitch
+    ax4.legend()  # legend on ax4 for Roll, Pitch and Yaw
 
     ax2.set_ylabel('Lat Accel (G)', fontsize=labelfontsize)
     ax3.set_ylabel('Vert Accel (G)', fontsize=labelfontsize)  # Z
@@ -104,149 +234,97 @@ def image_process(x, y, z, rpy, oiv, final, camerarate):
     ax1.set_ylabel('Long Accel (G)', fontsize=labelfontsize)  # X
     ax4.set_ylabel('Angles (degrees)', fontsize=labelfontsize)
 
-    ax1.set_xlim([0, final + .005])  # set x limits to 0 and +5 ms, ShareX = true
-    ax1.set_ylim([min(Xaccel_Avg) - 2, max(Xaccel_Avg) + 2])  # set y limits -4 and +4 data
-    ax4.set_ylim([min([min(Rolldata), min(Pitchdata), min(Yawdata)]) - 1,
-                  max([max(Rolldata), max(Pitchdata), max(Yawdata)]) + 1])  # set y limits -4 and +4 data
-
-    ax2.set_ylim([min(Yaccel_Avg) - 2, max(Yaccel_Avg) + 2])  # set y limits -4 and +4 data
-    ax3.set_ylim([min(Zaccel_Avg) - 2, max(Zaccel_Avg) + 2])  # set y limits -4 and +4 data
-
     ax1.grid()
     ax2.grid()
     ax3.grid()
     ax4.grid()
 
-    plt.subplots_adjust(wspace=0.1)
-
-    # for the 10 frames before impact,
-    # these plots will not 'move' but the text in the title should update each time
-    for i in range(10):
-        ax1.set_title(f"t={i - 10:6.0f} ms a=      g", fontsize=titlefontsize)
-        ax4.set_title(f"t={i - 10:6.0f} ms R=      P=     Y=     ", fontsize=titlefontsize)
-        ax2.set_title(f"t={i - 10:6.0f} ms a=      g", fontsize=titlefontsize)
-        ax3.set_title(f"t={i - 10:6.0f} ms a=      g", fontsize=titlefontsize)
-
-        plt.draw()  # required for the set_xdata command to activate
-        imgfilename = os.path.join(my_directory, f'{i+1}.png')
-        print(f"... saving {imgfilename}")  # keep the user updated where were are at
-        plt.savefig(imgfilename, transparent=False)  # save the figure as a png file.
-
-    dt = timedata[1] - timedata[0]
-    samples_per_sec = 1 / dt
-    increment = samples_per_sec / camerarate
-    num_images = int(final/dt//increment)
-
-    for ind in range(num_images):
-
-        x = int(ind * increment)  # every 30 samples
-
-        line1.set_xdata(timedata[0:x+1])
-        line1.set_ydata(Xaccel_Avg[0:x+1])
-
-        line2.set_xdata(timedata[0:x+1])
-        line2.set_ydata(Yaccel_Avg[0:x+1])
-
-        line3.set_xdata(timedata[0:x+1])
-        line3.set_ydata(Zaccel_Avg[0:x+1])
-
-        line4.set_xdata(timedata[0:x+1])
-        line4.set_ydata(Rolldata[0:x+1])
-
-        line5.set_xdata(timedata[0:x+1])
-        line5.set_ydata(Pitchdata[0:x+1])
-
-        line6.set_xdata(timedata[0:x+1])
-        line6.set_ydata(Yawdata[0:x+1])
-
-        ax1.set_title(f"t={timedata[x]:6.0f} ms a={Xaccel_Avg[x]:6.2f} g", fontsize=titlefontsize)
-
-        ax2.set_title(f"t={timedata[x]:6.0f} ms a={Yaccel_Avg[x]:6.2f} g", fontsize=titlefontsize)
-
-        ax3.set_title(f"t={timedata[x]:6.0f} ms a={Zaccel_Avg[x]:6.2f} g", fontsize=titlefontsize)
-
-        ax4.set_title(f"t={timedata[x]:6.0f} ms R={Rolldata[x]:5.1f} P={Pitchdata[x]:5.1f} Y={Yawdata[x]:5.1f}",
-                      fontsize=titlefontsize)
-
-        plt.draw()  # required for the set_xdata command to activate
-
-        imgfilename = os.path.join(my_directory, f'{ind+10}.png')
-        print(f"... saving {imgfilename}")  # keep the user updated where were are at
-        plt.savefig(imgfilename, transparent=False)  # # save the figure as a png file
-
-    return True
-
-
-def image_process_asi(x, y, z, rpy, asi, oiv, final, camerarate):
-
-    try:
-        oiv = float(oiv)
-        final = float(final)
-        camerarate = float(camerarate)
-    except ValueError:
-        print('WARNING: oiv, final, or camerarate could not be cast as a floating point number')
-        return False
-
+    # the titles are the only text that changes from frame to frame
+    for ax in (ax1, ax2, ax3, ax4):
+        ax.set_title('', fontsize=titlefontsize)
+
+    def fill(data, oiv, final):
+        timedata = data['Time']
+        Xaccel_Avg = data['X']
+        Yaccel_Avg = data['Y']
+        Zaccel_Avg = data['Z']
+        Rolldata = data['Roll']
+        Pitchdata = data['Pitch']
+        Yawdata = data['Yaw']
+
+        # ranges of the data for the axis limits
+        xmin, xmax = value_range(Xaccel_Avg)
+        ymin, ymax = value_range(Yaccel_Avg)
+        zmin, zmax = value_range(Zaccel_Avg)
+        anglemin, anglemax = value_range(Rolldata, Pitchdata, Yawdata)
+
+        oivline.set_data([oiv, oiv], [xmin - 4, xmax + 4])
+        trace1.set_data(*decimate_for_axes(ax1, timedata, Xaccel_Avg))
+        trace2.set_data(*decimate_for_axes(ax2, timedata, Yaccel_Avg))
+        trace3.set_data(*decimate_for_axes(ax3, timedata, Zaccel_Avg))
+        trace4.set_data(*decimate_for_axes(ax4, timedata, Rolldata))
+        trace5.set_data(*decimate_for_axes(ax4, timedata, Pitchdata))
+        trace6.set_data(*decimate_for_axes(ax4, timedata, Yawdata))
+        # the moving lines still hold the last frame of the previous job
+        for line in (line1, line2, line3, line4, line5, line6):
+            line.set_data([], [])
+
+        ax1.set_xlim([0, final + .005])  # set x limits to 0 and +5 ms, ShareX = true
+        ax1.set_ylim([xmin - 2, xmax + 2])  # set y limits -4 and +4 data
+        ax4.set_ylim([anglemin - 1, anglemax + 1])  # set y limits -4 and +4 data
+
+        ax2.set_ylim([ymin - 2, ymax + 2])  # set y limits -4 and +4 data
+        ax3.set_ylim([zmin - 2, zmax + 2])  # set y limits -4 and +4 data
+
+        lines = [(line1, Xaccel_Avg), (line2, Yaccel_Avg), (line3, Zaccel_Avg),
+                 (line4, Rolldata), (line5, Pitchdata), (line6, Yawdata)]
+
+        def titles(frame):
+            if frame.sample is None:
+                i = frame.countdown
+                return [(ax1, f"t={i:6.0f} ms a=      g"),
+                        (ax4, f"t={i:6.0f} ms R=      P=     Y=     "),
+                        (ax2, f"t={i:6.0f} ms a=      g"),
+                        (ax3, f"t={i:6.0f} ms a=      g")]
+
+            x = frame.sample
+            return [(ax1, f"t={timedata[x]:6.0f} ms a={Xaccel_Avg[x]:6.2f} g"),
+                    (ax2, f"t={timedata[x]:6.0f} ms a={Yaccel_Avg[x]:6.2f} g"),
+                    (ax3, f"t={timedata[x]:6.0f} ms a={Zaccel_Avg[x]:6.2f} g"),
+                    (ax4, f"t={timedata[x]:6.0f} ms R={Rolldata[x]:5.1f} P={Pitchdata[x]:5.1f} Y={Yawdata[x]:5.1f}")]
+
+        return lines, titles
+
+    return FigureTemplate(fig, fill)
+
+
+def en1317_figure(dpi=DPI):
     labelfontsize = 14
     titlefontsize = 20
 
-    if not os.path.exists(os.path.join(os.path.dirname(x), 'generated_images')):
-        os.makedirs(os.path.join(os.path.dirname(x), 'generated_images'))
-
-    my_directory = os.path.join(os.path.dirname(x), 'generated_images')
-
-    # read in 2-3 seconds of data and then query it to the final time
-    try:
-        dfx = pd.read_csv(x, skiprows=[0, 1, 2, 4], usecols=[0, 1], nrows=60000)
-        dfy = pd.read_csv(y, skiprows=[0, 1, 2, 4], usecols=[0, 1], nrows=60000)
-        dfz = pd.read_csv(z, skiprows=[0, 1, 2, 4], usecols=[0, 1], nrows=60000)
-        dfRPY = pd.read_csv(rpy, skiprows=[0, 1, 2, 4], nrows=60000).query(f'Time < {final}')
-        dfASI = pd.read_csv(asi, skiprows=[0, 1, 2, 4], nrows=60000).query(f'Time < {final}')
-    except:
-        print('WARNING: something went wrong while reading input '
-              'files. Double check that you are uploading the correct files.')
-        return False
-
-    try:
-        xyz = tweak_xyz(dfx, dfy, dfz, final)
-    except AttributeError:
-        print('WARNING: input files are not in the correct format, or they are corrupted. Cancelling the operation.')
-        return False
+    fig, ((ax1, ax2), (ax3, ax4)) = new_figure(dpi)
 
-    # separate the columns into numpy arrays
-    timedata = xyz.Time.to_numpy()
-    Xaccel_Avg = xyz.X.to_numpy()
-    Yaccel_Avg = xyz.Y.to_numpy()
-    Zaccel_Avg = xyz.Z.to_numpy()
-    Rolldata = dfRPY['Roll Angle'].to_numpy()
-    Pitchdata = dfRPY['Pitch Angle'].to_numpy()
-    Yawdata = dfRPY['Yaw Angle'].to_numpy()
-    ASIdata = dfASI.ASI.to_numpy()
+    oivline, = ax1.plot([], [], 'r--', lw=1, label='Time of THIV')  # plot OIV
+    trace1, = ax1.plot([], [], 'b:', lw=.6)  # plot all the X data with a light dotted line
+    line1, = ax1.plot([], [], 'b-', lw=2)
 
-    # plotting
-    fig, ((ax1, ax2), (ax3, ax4)) = plt.subplots(2, 2, sharex=True, figsize=(30, 8), dpi=64)  # gives 512*1920 images
+    trace7, = ax2.plot([], [], 'b:', lw=.6)  # plot all the ASI data with a light dotted line
+    line7, = ax2.plot([], [], 'b-', lw=2)
 
-    ax1.plot([oiv, oiv], [min(Xaccel_Avg) - 4, max(Xaccel_Avg) + 4], 'r--', lw=1, label='Time of THIV')  # plot OIV
-    ax1.plot(timedata, Xaccel_Avg, 'b:', lw=.6)  # plot all the X data with a light dotted line
-    line1, = ax1.plot(timedata[0:0], Xaccel_Avg[0:0], 'b-', lw=2)
+    trace2, = ax3.plot([], [], 'b:', lw=.6)  # plot all the Y data with a light dotted line
+    line2, = ax3.plot([], [], 'b-', lw=2, label='Y Accel')
 
-    ax2.plot(timedata, ASIdata, 'b:', lw=.6)  # plot all the X data with a light dotted line
-    line7, = ax2.plot(timedata[0:0], ASIdata[0:0], 'b-', lw=2)  # st
+    trace3, = ax3.plot([], [], 'r:', lw=.6)  # plot all the Z data with a light dotted line
+    line3, = ax3.plot([], [], 'r-', lw=2, label='Z Accel')
 
-    ax3.plot(timedata, Yaccel_Avg, 'b:', lw=.6)  # plot all the X data with a light dotted line
-    line2, = ax3.plot(timedata[0:0], Yaccel_Avg[0:0], 'b-', lw=2, label='Y Accel')  # st
+    trace4, = ax4.plot([], [], 'b:', lw=.6)  # plot all the Roll data with a light dotted line
+    line4, = ax4.plot([], [], 'b-', lw=2, label='Roll')
 
-    ax3.plot(timedata, Zaccel_Avg, 'r:', lw=.6)  # plot all the Z data with a light dotted line
-    line3, = ax3.plot(timedata[0:0], Zaccel_Avg[0:0], 'r-', lw=2, label='Z Accel')  #
+    trace5, = ax4.plot([], [], 'r:', lw=.6)  # plot all the Pitch data with a light dotted line
+    line5, = ax4.plot([], [], 'r-', lw=2, label='Pitch')
 
-    ax4.plot(timedata, Rolldata, 'b:', lw=.6)  # plot all the Roll data with a light dotted line
-    line4, = ax4.plot(timedata[0:0], Rolldata[0:0], 'b-', lw=2, label='Roll')
-
-    ax4.plot(timedata, Pitchdata, 'r:', lw=.6)  # plot all the Pitch data with a light dotted line
-    line5, = ax4.plot(timedata[0:0], Pitchdata[0:0], 'r-', lw=2, label='Pitch')
-
-    ax4.plot(timedata, Yawdata, 'k:', lw=.6)  # plot all the Pitch data with a light dotted line
-    line6, = ax4.plot(timedata[0:0], Yawdata[0:0], 'k-', lw=2, label='Yaw')
+    trace6, = ax4.plot([], [], 'k:', lw=.6)  # plot all the Yaw data with a light dotted line
+    line6, = ax4.plot([], [], 'k-', lw=2, label='Yaw')
 
     ax1.legend()  # legend on ax1 for OIV
     ax3.legend()  # legend on ax3 for Y and Z
@@ -259,77 +337,328 @@ def image_process_asi(x, y, z, rpy, asi, oiv, final, camerarate):
     ax1.set_ylabel('Long Accel (G)', fontsize=labelfontsize)  # X
     ax4.set_ylabel('Angles (degrees)', fontsize=labelfontsize)
 
-    ax1.set_xlim([0, final + .005])  # set x limits to 0 and +5 ms, ShareX = true
-    ax1.set_ylim([min(Xaccel_Avg) - 2, max(Xaccel_Avg) + 2])  # set y limits -4 and +4 data
-    ax4.set_ylim([min([min(Rolldata), min(Pitchdata), min(Yawdata)]) - 1,
-                  max([max(Rolldata), max(Pitchdata), max(Yawdata)]) + 1])  # set y limits -4 and +4 data
-
-    ax2.set_ylim([0, max(ASIdata) + .2])  # set asi limits
-    ax3.set_ylim([min([min(Yaccel_Avg), min(Zaccel_Avg)]) - 2, max([max(Yaccel_Avg), max(Zaccel_Avg)]) + 2])
-
     ax1.grid()
     ax2.grid()
     ax3.grid()
     ax4.grid()
 
-    plt.subplots_adjust(wspace=0.1)
+    # the titles are the only text that changes from frame to frame
+    for ax in (ax1, ax2, ax3, ax4):
+        ax.set_title('', fontsize=titlefontsize)
+
+    def fill(data, oiv, final):
+        timedata = data['Time']
+        Xaccel_Avg = data['X']
+        Yaccel_Avg = data['Y']
+        Zaccel_Avg = data['Z']
+        Rolldata = data['Roll']
+        Pitchdata = data['Pitch']
+        Yawdata = data['Yaw']
+        ASIdata = data['ASI']
+
+        # ranges of the data for the axis limits
+        xmin, xmax = value_range(Xaccel_Avg)
+        yzmin, yzmax = value_range(Yaccel_Avg, Zaccel_Avg)
+        anglemin, anglemax = value_range(Rolldata, Pitchdata, Yawdata)
+        asimax = value_range(ASIdata)[1]
+
+        oivline.set_data([oiv, oiv], [xmin - 4, xmax + 4])
+        trace1.set_data(*decimate_for_axes(ax1, timedata, Xaccel_Avg))
+        trace7.set_data(*decimate_for_axes(ax2, timedata, ASIdata))
+        trace2.set_data(*decimate_for_axes(ax3, timedata, Yaccel_Avg))
+        trace3.set_data(*decimate_for_axes(ax3, timedata, Zaccel_Avg))
+        trace4.set_data(*decimate_for_axes(ax4, timedata, Rolldata))
+        trace5.set_data(*decimate_for_axes(ax4, timedata, Pitchdata))
+        trace6.set_data(*decimate_for_axes(ax4, timedata, Yawdata))
+        # the moving lines still hold the last frame of the previous job
+        for line in (line1, line2, line3, line4, line5, line6, line7):
+            line.set_data([], [])
+
+        ax1.set_xlim([0, final + .005])  # set x limits to 0 and +5 ms, ShareX = true
+        ax1.set_ylim([xmin - 2, xmax + 2])  # set y limits -4 and +4 data
+        ax4.set_ylim([anglemin - 1, anglemax + 1])  # set y limits -4 and +4 data
+
+        ax2.set_ylim([0, asimax + .2])  # set asi limits
+        ax3.set_ylim([yzmin - 2, yzmax + 2])
+
+        lines = [(line1, Xaccel_Avg), (line2, Yaccel_Avg), (line3, Zaccel_Avg),
+                 (line4, Rolldata), (line5, Pitchdata), (line6, Yawdata), (line7, ASIdata)]
+
+        def titles(frame):
+            if frame.sample is None:
+                i = frame.countdown
+                return [(ax1, f"t={i:6.0f} ms a=      g"),
+                        (ax4, f"t={i:6.0f} ms R=      P=     Y=     "),
+                        (ax2, f"t={i:6.0f} ms ASI=      "),
+                        (ax3, f"t={i:6.0f} ms a_y=   g, a_z=    g")]
+
+            x = frame.sample
+            return [(ax1, f"t={timedata[x]:6.0f} ms a={Xaccel_Avg[x]:6.2f} g"),
+                    (ax2, f"t={timedata[x]:6.0f} ms ASI={ASIdata[x]:6.2f}"),
+                    (ax3, f"t={timedata[x]:6.0f} ms a_y={Yaccel_Avg[x]:6.2f} g, a_z={Zaccel_Avg[x]:6.2f} g"),
+                    (ax4, f"t={timedata[x]:6.0f} ms R={Rolldata[x]:5.1f} P={Pitchdata[x]:5.1f} Y={Yawdata[x]:5.1f}")]
+
+        return lines, titles
+
+    return FigureTemplate(fig, fill)
+
+
+# free templates by (layout, dpi). a template is only ever used by one job at a time
+template_pool = {}
+template_lock = threading.Lock()
+
+
+def reset_templates():
+    # a forked process (a job worker, see jobs.py) could inherit the lock while a preview thread of its
+    # parent held it, and templates that thread was using. it starts with a pool of its own
+    global template_lock
+    template_lock = threading.Lock()
+    template_pool.clear()
+
+
+os.register_at_fork(after_in_child=reset_templates)
+
+
+@contextmanager
+def figure_template(figure, dpi=DPI):
+    """Lend a template of the layout figure (mash_figure or en1317_figure) for the block.
+
+    A free one is reused if there is one, otherwise a new one is built. Afterwards it goes back to the
+    pool, unless TEMPLATE_POOL_SIZE of them are already waiting there.
+    """
+    key = (figure.__name__, dpi)
+    with template_lock:
+        free = template_pool.setdefault(key, [])
+        template = free.pop() if free else None
+    if template is None:
+        with metrics.stage('images.layout'):
+            template = figure(dpi)
+    try:
+        yield template
+    finally:
+        with template_lock:
+            if len(free) < TEMPLATE_POOL_SIZE:
+                free.append(template)
+
+
+class FrameRenderer:
+    """Render frames by blitting the moving lines and the titles onto a cached background.
+
+    Everything else in the figure (axes, grids, dotted full traces, legends) is identical
+    in every frame, so it is drawn once and restored from a pixel copy for each frame
+    instead of re-rendering the whole figure for every frame.
+    """
+
+    def __init__(self, fig, timedata, lines, titles, encoding='png'):
+        self.fig = fig
+        self.timedata = timedata
+        self.titles = titles
+        self.encoding = encoding
+
+        # the moving lines only draw the samples that show at the width of their axes: the smallest and
+        # largest sample of every pixel (see minmax_indices), and all the samples of the pixel being drawn.
+        # size is the number of samples per pixel
+        self.lines = []
+        for line, ydata in lines:
+            pixels = max(1, int(line.axes.get_window_extent().width))
+            keep = minmax_indices(ydata, pixels)
+            size = 1 if len(keep) == len(ydata) else -(-len(ydata) // pixels)
+            self.lines.append((line, ydata, keep, size))
+
+        # animated artists are left out of a full draw, so the background has no lines or titles
+        for artist in [line for line, *_ in self.lines] + [ax.title for ax in fig.axes]:
+            artist.set_animated(True)
+        fig.canvas.draw()
+        self.background = fig.canvas.copy_from_bbox(fig.bbox)
+
+    def render(self, frame):
+        canvas = self.fig.canvas
+        started = time.perf_counter()
+        canvas.restore_region(self.background)
+
+        stop = 0 if frame.sample is None else frame.sample + 1
+        for line, ydata, keep, size in self.lines:
+            tail = max(stop - size, 0)
+            shown = np.concatenate([keep[:np.searchsorted(keep, tail)], np.arange(tail, stop)])
+            line.set_data(self.timedata[shown], ydata[shown])
+            line.axes.draw_artist(line)
+
+        for ax, title in self.titles(frame):
+            ax.title.set_text(title)
+            ax.draw_artist(ax.title)
+        metrics.record_stage('images.draw', time.perf_counter() - started)
+
+        with metrics.stage('images.encode'):
+            return encode_frame(canvas.buffer_rgba(), self.encoding, self.fig.dpi)
+
+
+def encode_frame(rgba, encoding, dpi):
+    # encode the RGBA buffer of the Agg canvas in memory, without going through matplotlib
+    _, fmt, options = FRAME_ENCODINGS[encoding]
+    if fmt is None:
+        return bytes(rgba)
+
+    image = Image.fromarray(np.asarray(rgba))
+    if fmt == 'JPEG':
+        image = image.convert('RGB')
+
+    buf = BytesIO()
+    image.save(buf, format=fmt, dpi=(dpi, dpi), **options)
+    return buf.getvalue()
+
+
+# the renderer of a pool worker process, built once by init_worker
+worker_renderer = None
+
+
+def init_worker(figure, data, oiv, final, dpi, encoding):
+    # each worker builds its own copy of the figure once and renders its share of the frames
+    global worker_renderer
+    template = figure(dpi)
+    lines, titles = template.fill(data, oiv, final)
+    worker_renderer = FrameRenderer(template.fig, data['Time'], lines, titles, encoding)
+
+
+def render_in_worker(frames):
+    # the timings of the batch go back with it, see metrics.separate_registry
+    with metrics.separate_registry() as registry:
+        batch = [(frame.number, worker_renderer.render(frame)) for frame in frames]
+    return batch, registry
+
+
+def rendered_frames(figure, data, oiv, final, frames, processes=1, encoding='png', dpi=DPI):
+    """Yield (frame number, encoded bytes) for every frame, in the order of the plan."""
+    if processes <= 1 or len(frames) < 2:
+        with figure_template(figure, dpi) as template:
+            with metrics.stage('images.figure'):
+                lines, titles = template.fill(data, oiv, final)
+                renderer = FrameRenderer(template.fig, data['Time'], lines, titles, encoding)
+            for frame in frames:
+                yield frame.number, renderer.render(frame)
+        return
+
+    # every frame only depends on its own sample index, so the frames can be handed out
+    # to the workers in small contiguous batches. map() returns the batches in order.
+    processes = min(processes, len(frames))
+    batches = [frames[start:start + 8] for start in range(0, len(frames), 8)]
+    with ProcessPoolExecutor(max_workers=processes, initializer=init_worker,
+                             initargs=(figure, data, oiv, final, dpi, encoding)) as executor:
+        for batch, registry in executor.map(render_in_worker, batches):
+            metrics.merge(registry)
+            yield from batch
+
+
+def render_images(figure, data, oiv, final, camerarate, destination, processes=1, encoding='png',
+                  step=1, dpi=DPI, progress=None):
+    # progress, if given, is called with (frames done, total frames) after every frame
+    frames = frame_plan(data['Time'], final, camerarate, step)
+    extension, fmt, _ = FRAME_ENCODINGS[encoding]
+
+    # png and jpeg frames are already compressed, so they are stored in the zip as they are.
+    # raw frames get the cheapest deflate level to keep the archive a reasonable size.
+    if fmt is None:
+        archive = zipfile.ZipFile(destination, 'w', zipfile.ZIP_DEFLATED, compresslevel=1)
+    else:
+        archive = zipfile.ZipFile(destination, 'w', zipfile.ZIP_STORED)
+
+    with archive:
+        for done, (number, encoded) in enumerate(rendered_frames(figure, data, oiv, final, frames,
+                                                                 processes=processes, encoding=encoding,
+                                                                 dpi=dpi), 1):
+            imgfilename = f'generated_images/{number}.{extension}'
+            with metrics.stage('images.archive'):
+                archive.writestr(imgfilename, encoded)
+            metrics.count('frames_rendered_total', encoding=encoding)
+            if progress is not None:
+                progress(done, len(frames))
+
+        if fmt is None:
+            # raw frames have no header, so record their size for whoever reads them back
+            archive.comment = f'{FIGSIZE[0] * dpi:.0f}x{FIGSIZE[1] * dpi:.0f} RGBA'.encode()
+
+
+def image_process(x, y, z, rpy, oiv, final, camerarate, processes=1, destination=None, encoding='png',
+                  step=1, dpi=DPI, progress=None):
 
-    # for the 10 frames before impact,
-    # these plots will not 'move' but the text in the title should update each time
-    for i in range(10):
-        ax1.set_title(f"t={i - 10:6.0f} ms a=      g", fontsize=titlefontsize)
-        ax4.set_title(f"t={i - 10:6.0f} ms R=      P=     Y=     ", fontsize=titlefontsize)
-        ax2.set_title(f"t={i - 10:6.0f} ms ASI=      ", fontsize=titlefontsize)
-        ax3.set_title(f"t={i - 10:6.0f} ms a_y=   g, a_z=    g", fontsize=titlefontsize)
+    try:
+        oiv = float(oiv)
+        final = float(final)
+        camerarate = float(camerarate)
+    except ValueError:
+        print('WARNING: oiv, final, or camerarate could not be cast as a floating point number')
+        return False
 
-        plt.draw()  # required for the set_xdata command to activate
-        imgfilename = os.path.join(my_directory, f'{i + 1}.png')
-        print(f"... saving {imgfilename}")  # keep the user updated where were are at
-        plt.savefig(imgfilename, transparent=False)  # save the figure as a png file.
+    if encoding not in FRAME_ENCODINGS:
+        print(f'WARNING: {encoding} is not a known image encoding')
+        return False
 
-    dt = timedata[1] - timedata[0]
-    samples_per_sec = 1 / dt
-    increment = samples_per_sec / camerarate
-    num_images = int(final / dt // increment)
+    # the zip file with the generated images goes next to the input files unless told otherwise
+    if destination is None:
+        destination = os.path.join(os.path.dirname(recording_cache.source_name(x)), 'generated_images.zip')
 
-    for ind in range(num_images):
-        x = int(ind * increment)  # every 30 samples
+    try:
+        data = load_channels(final, x, y, z, rpy)
+    except ValueError as e:
+        print(f'WARNING: {e}. Double check that you are uploading the correct files.')
+        return False
 
-        line1.set_xdata(timedata[0:x + 1])
-        line1.set_ydata(Xaccel_Avg[0:x + 1])
+    render_images(mash_figure, data, oiv, final, camerarate, destination,
+                  processes=processes, encoding=encoding, step=step, dpi=dpi, progress=progress)
 
-        line2.set_xdata(timedata[0:x + 1])
-        line2.set_ydata(Yaccel_Avg[0:x + 1])
+    return True
 
-        line3.set_xdata(timedata[0:x + 1])
-        line3.set_ydata(Zaccel_Avg[0:x + 1])
 
-        line4.set_xdata(timedata[0:x + 1])
-        line4.set_ydata(Rolldata[0:x + 1])
+def image_process_asi(x, y, z, rpy, asi, oiv, final, camerarate, processes=1, destination=None,
+                      encoding='png', step=1, dpi=DPI, progress=None):
 
-        line5.set_xdata(timedata[0:x + 1])
-        line5.set_ydata(Pitchdata[0:x + 1])
+    try:
+        oiv = float(oiv)
+        final = float(final)
+        camerarate = float(camerarate)
+    except ValueError:
+        print('WARNING: oiv, final, or camerarate could not be cast as a floating point number')
+        return False
 
-        line6.set_xdata(timedata[0:x + 1])
-        line6.set_ydata(Yawdata[0:x + 1])
+    if encoding not in FRAME_ENCODINGS:
+        print(f'WARNING: {encoding} is not a known image encoding')
+        return False
 
-        line7.set_xdata(timedata[0:x + 1])
-        line7.set_ydata(ASIdata[0:x + 1])
+    # the zip file with the generated images goes next to the input files unless told otherwise
+    if destination is None:
+        destination = os.path.join(os.path.dirname(recording_cache.source_name(x)), 'generated_images.zip')
 
-        ax1.set_title(f"t={timedata[x]:6.0f} ms a={Xaccel_Avg[x]:6.2f} g", fontsize=titlefontsize)
+    try:
+        data = load_channels(final, x, y, z, rpy, asi=asi)
+    except ValueError as e:
+        print(f'WARNING: {e}. Double check that you are uploading the correct files.')
+        return False
+
+    render_images(en1317_figure, data, oiv, final, camerarate, destination,
+                  processes=processes, encoding=encoding, step=step, dpi=dpi, progress=progress)
+
+    return True
 
-        ax2.set_title(f"t={timedata[x]:6.0f} ms ASI={ASIdata[x]:6.2f}", fontsize=titlefontsize)
 
-        ax3.set_title(f"t={timedata[x]:6.0f} ms a_y={Yaccel_Avg[x]:6.2f} g, a_z={Zaccel_Avg[x]:6.2f} g",
-                      fontsize=titlefontsize)
+def image_process_data(data, oiv, final, camerarate, destination, processes=1, encoding='png', step=1, dpi=DPI,
+                       progress=None):
+    """Render channels that were already read by load_channels, for instance from the uploads of an earlier request.
 
-        ax4.set_title(f"t={timedata[x]:6.0f} ms R={Rolldata[x]:5.1f} P={Pitchdata[x]:5.1f} Y={Yawdata[x]:5.1f}",
-                      fontsize=titlefontsize)
+    The EN 1317 layout is used when the data has an ASI channel.
+    """
+    try:
+        oiv = float(oiv)
+        final = float(final)
+        camerarate = float(camerarate)
+    except (TypeError, ValueError):
+        print('WARNING: oiv, final, or camerarate could not be cast as a floating point number')
+        return False
 
-        plt.draw()  # required for the set_xdata command to activate
+    if encoding not in FRAME_ENCODINGS:
+        print(f'WARNING: {encoding} is not a known image encoding')
+        return False
 
-        imgfilename = os.path.join(my_directory, f'{ind + 10}.png')
-        print(f"... saving {imgfilename}")  # keep the user updated where were are at
-        plt.savefig(imgfilename, transparent=False)  # # save the figure as a png file
+    figure = en1317_figure if 'ASI' in data else mash_figure
+    render_images(figure, data, oiv, final, camerarate, destination,
+                  processes=processes, encoding=encoding, step=step, dpi=dpi, progress=progress)
 
     return True
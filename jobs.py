@@ -0,0 +1,140 @@
+"""Long running work (image generation) as background jobs, run by a pool of worker processes.
+
+Every job has its own workspace, with its result and a small status.json in it. Only the
+worker running the job writes to it, and any web worker can read it, so a job can be
+followed from another web worker than the one that started it.
+"""
+import functools
+import json
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import metrics
+import workspaces
+
+
+# number of jobs each web worker process runs at the same time
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 2))
+# progress is written to the status file at most this often, in seconds
+PROGRESS_INTERVAL = 0.5
+
+# the pool of the current process. a forked web worker starts its own
+executor = None
+executor_pid = None
+
+
+def job_pool():
+    global executor, executor_pid
+    if executor is not None and executor_pid == os.getpid() and executor._broken:
+        # a worker died (killed for running out of memory, for instance), and the pool takes no more jobs
+        executor.shutdown(wait=False)
+        executor = None
+    if executor is None or executor_pid != os.getpid():
+        executor = ProcessPoolExecutor(max_workers=JOB_WORKERS)
+        executor_pid = os.getpid()
+    return executor
+
+
+def read_status(job_id):
+    """Return the status dict of a job, or None if there is no such job."""
+    if not workspaces.valid_id(job_id):
+        return None
+    try:
+        with open(workspaces.path(job_id, 'status.json')) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_status(job_id, **changes):
+    status = read_status(job_id) or {}
+    status.update(changes, updated=time.time())
+
+    # written to a temporary file and moved into place, so a reader never sees half of it
+    fd, tmppath = tempfile.mkstemp(dir=workspaces.path(job_id), suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(status, f)
+    os.replace(tmppath, workspaces.path(job_id, 'status.json'))
+
+
+def create(result):
+    """Start a new queued job in a new workspace and return its id.
+
+    result is the file name of what the job produces.
+    """
+    job_id = workspaces.create()
+    write_status(job_id, id=job_id, state='queued', done=0, total=None, message='', result=result,
+                 created=time.time())
+    return job_id
+
+
+def result_path(job_id):
+    return workspaces.path(job_id, read_status(job_id)['result'])
+
+
+def start(job_id, function, *args, **kwargs):
+    """Run function(*args, progress=callback, **kwargs) in the job pool.
+
+    function has to report success by returning something true, and can call progress(done, total)
+    along the way. A job that cannot be started is marked failed.
+    """
+    try:
+        try:
+            future = job_pool().submit(run_job, job_id, function, args, kwargs)
+        except BrokenProcessPool:
+            # the pool broke after it was checked. job_pool starts a new one
+            future = job_pool().submit(run_job, job_id, function, args, kwargs)
+    except Exception as e:
+        print(f'WARNING: job {job_id} could not be started ({e!r})')
+        write_status(job_id, state='failed', message=f'the job could not be started ({e!r})')
+        metrics.count('image_jobs_total', state='failed')
+        return
+    future.add_done_callback(functools.partial(merge_job_metrics, job_id))
+
+
+def merge_job_metrics(job_id, future):
+    # the job records its metrics in the job worker, they are added to the ones of this process at the end
+    error = future.exception()
+    if error is None:
+        metrics.merge(future.result())
+        return
+
+    # the job worker died before the job could write how it ended, or the job never ran
+    print(f'WARNING: job {job_id} failed with {error!r}')
+    write_status(job_id, state='failed', message=f'the job worker stopped unexpectedly ({error!r})')
+    metrics.count('image_jobs_total', state='failed')
+
+
+def run_job(job_id, function, args, kwargs):
+    with metrics.separate_registry() as registry, metrics.stage('job.run'):
+        metrics.count('image_jobs_total', state=run_function(job_id, function, args, kwargs))
+    return registry
+
+
+def run_function(job_id, function, args, kwargs):
+    # returns the state the job ended in
+    write_status(job_id, state='running', started=time.time())
+
+    last_written = 0
+
+    def progress(done, total):
+        nonlocal last_written
+        now = time.monotonic()
+        if done == total or now - last_written >= PROGRESS_INTERVAL:
+            write_status(job_id, done=done, total=total)
+            last_written = now
+
+    try:
+        succeeded = function(*args, progress=progress, **kwargs)
+    except Exception as e:
+        print(f'WARNING: job {job_id} failed with {e!r}')
+        write_status(job_id, state='failed', message=f'the job failed with {e!r}')
+        return 'failed'
+
+    if succeeded:
+        write_status(job_id, state='done', finished=time.time())
+        return 'done'
+    write_status(job_id, state='failed', message='processing failed, double check the input files')
+    return 'failed'
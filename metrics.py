@@ -0,0 +1,203 @@
+"""Counters and stage timings of the app, served in the Prometheus text format on /metrics.
+
+Every web worker keeps its own numbers and writes them to METRICS_FOLDER every FLUSH_INTERVAL
+seconds, and /metrics adds up the files of all of them. Job and render worker processes do not
+write files: they record into a registry of their own and hand it back with their result, and the
+web worker that started them merges it in.
+
+The stages timed during a request are also sent back in its Server-Timing header.
+"""
+import json
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+import recording_cache
+
+
+METRICS_FOLDER = os.environ.get('METRICS_FOLDER', os.path.join(recording_cache.CACHE_FOLDER, 'metrics'))
+# the numbers of a web worker are written to its file at most this often, in seconds
+FLUSH_INTERVAL = 5
+# every metric name starts with this
+PREFIX = 'etech_'
+# upper bounds of the histogram buckets, in seconds
+BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120)
+
+HELP = {
+    'stage_seconds': ('histogram', 'Time spent in each processing stage'),
+    'request_seconds': ('histogram', 'Time to answer a request, by endpoint'),
+    'requests_total': ('counter', 'Requests answered, by endpoint and status code'),
+    'bytes_in_total': ('counter', 'Bytes uploaded, by endpoint'),
+    'bytes_out_total': ('counter', 'Bytes sent back, by endpoint'),
+    'speed_results_total': ('counter', 'Speed calculations, by errorflag'),
+    'result_cache_total': ('counter', 'Speed result cache lookups, by result'),
+    'frames_rendered_total': ('counter', 'Image frames rendered, by encoding'),
+    'image_jobs_total': ('counter', 'Image jobs finished, by state'),
+}
+
+# {'counters': {key: value}, 'histograms': {key: [count per bucket..., count above, sum]}}
+# with key = 'name\tlabels'
+registry = {'counters': {}, 'histograms': {}}
+lock = threading.Lock()
+# the stages timed by the request being answered in this thread
+request_stages = threading.local()
+
+last_flush = 0
+# the file of this process was read back in, see flush
+loaded_pid = None
+
+
+def reset_lock():
+    # a forked process could inherit the lock while another thread of its parent held it
+    global lock
+    lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=reset_lock)
+
+
+def series_key(name, labels):
+    return name + '\t' + ','.join(f'{label}="{value}"' for label, value in sorted(labels.items()))
+
+
+def count(name, amount=1, **labels):
+    key = series_key(name, labels)
+    with lock:
+        counters = registry['counters']
+        counters[key] = counters.get(key, 0) + amount
+
+
+def observe(name, seconds, **labels):
+    key = series_key(name, labels)
+    with lock:
+        histogram = registry['histograms'].setdefault(key, [0] * (len(BUCKETS) + 2))
+        # the buckets are counted one by one here, and added up when they are written out
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                histogram[i] += 1
+                break
+        else:
+            histogram[len(BUCKETS)] += 1
+        histogram[-1] += seconds
+
+
+def record_stage(stage, seconds):
+    observe('stage_seconds', seconds, stage=stage)
+    stages = getattr(request_stages, 'stages', None)
+    if stages is not None:
+        stages[stage] = stages.get(stage, 0) + seconds
+
+
+@contextmanager
+def stage(name):
+    """Time the block as stage name."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(name, time.perf_counter() - start)
+
+
+def begin_request():
+    request_stages.stages = {}
+
+
+def end_request():
+    """Return the Server-Timing header value for the stages of the request of this thread."""
+    stages = getattr(request_stages, 'stages', None) or {}
+    request_stages.stages = None
+    return ', '.join(f'{name.replace(".", "-")};dur={seconds * 1000:.1f}' for name, seconds in stages.items())
+
+
+@contextmanager
+def separate_registry():
+    """Record into a new registry while the block runs, and yield it.
+
+    For worker processes, which send their numbers back to the web worker instead of writing them.
+    """
+    global registry
+    saved = registry
+    registry = {'counters': {}, 'histograms': {}}
+    try:
+        yield registry
+    finally:
+        registry = saved
+
+
+def merge(other, into=None):
+    """Add the numbers of another registry to this one (or to into)."""
+    with lock:
+        target = registry if into is None else into
+        for key, value in other['counters'].items():
+            target['counters'][key] = target['counters'].get(key, 0) + value
+        for key, values in other['histograms'].items():
+            histogram = target['histograms'].setdefault(key, [0] * (len(BUCKETS) + 2))
+            for i, value in enumerate(values):
+                histogram[i] += value
+
+
+def flush(force=False):
+    """Write the numbers of this process to its file, at most every FLUSH_INTERVAL seconds unless forced."""
+    global last_flush, loaded_pid
+    if not force and time.monotonic() - last_flush < FLUSH_INTERVAL:
+        return
+    last_flush = time.monotonic()
+
+    os.makedirs(METRICS_FOLDER, exist_ok=True)
+    path = os.path.join(METRICS_FOLDER, f'{os.getpid()}.json')
+    if loaded_pid != os.getpid():
+        # a file with our pid is from a process that is gone. carry its numbers on, so no counter goes down
+        loaded_pid = os.getpid()
+        previous = read_registry(path)
+        if previous is not None:
+            merge(previous)
+
+    with lock:
+        snapshot = json.dumps(registry)
+    fd, tmppath = tempfile.mkstemp(dir=METRICS_FOLDER, suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        f.write(snapshot)
+    os.replace(tmppath, path)
+
+
+def read_registry(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def exposition():
+    """Return the numbers of all the web workers in the Prometheus text format."""
+    flush(force=True)
+
+    total = {'counters': {}, 'histograms': {}}
+    for name in os.listdir(METRICS_FOLDER):
+        if name.endswith('.json'):
+            other = read_registry(os.path.join(METRICS_FOLDER, name))
+            if other is not None:
+                merge(other, into=total)
+
+    lines = []
+    for metric, (kind, text) in HELP.items():
+        lines += [f'# HELP {PREFIX}{metric} {text}', f'# TYPE {PREFIX}{metric} {kind}']
+        series = total['counters'] if kind == 'counter' else total['histograms']
+        for key in sorted(series):
+            name, labels = key.split('\t')
+            if name != metric:
+                continue
+            if kind == 'counter':
+                lines.append(f'{PREFIX}{name}{{{labels}}} {series[key]}')
+                continue
+
+            values = series[key]
+            cumulative = 0
+            for bound, value in zip(BUCKETS + ('+Inf',), values):
+                cumulative += value
+                le = ','.join(filter(None, [labels, f'le="{bound}"']))
+                lines.append(f'{PREFIX}{name}_bucket{{{le}}} {cumulative}')
+            lines.append(f'{PREFIX}{name}_sum{{{labels}}} {values[-1]}')
+            lines.append(f'{PREFIX}{name}_count{{{labels}}} {cumulative}')
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,151 @@
+import hashlib
+import io
+import json
+import os
+import tempfile
+import numpy as np
+
+
+# parsed recordings are kept here as raw float64 arrays next to a small json description
+CACHE_FOLDER = os.environ.get('RECORDING_CACHE_FOLDER',
+                              os.path.join(os.path.abspath(os.path.dirname(__file__)), 'cache'))
+# least recently used recordings are deleted once the cache grows past this size
+CACHE_MAX_BYTES = int(os.environ.get('RECORDING_CACHE_MAX_BYTES', 512 * 1024 * 1024))
+
+
+def as_source(source):
+    """Recordings come as a path or as a seekable binary file-like object. Bytes are wrapped into one."""
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return io.BytesIO(source)
+    return source
+
+
+def source_name(source):
+    # file name of a path or of an uploaded file, for messages and output file names
+    if isinstance(source, (str, os.PathLike)):
+        return os.fspath(source)
+    name = getattr(source, 'filename', None) or getattr(source, 'name', None)
+    return name if isinstance(name, str) else 'upload.csv'
+
+
+def file_digest(source):
+    sha = hashlib.sha256()
+    if hasattr(source, 'read'):
+        # a file-like object is read from the start and left there for the parser
+        source.seek(0)
+        while block := source.read(1024 * 1024):
+            sha.update(block)
+        source.seek(0)
+        return sha.hexdigest()
+
+    with open(source, 'rb') as f:
+        while block := f.read(1024 * 1024):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def cache_key(filename, *tags):
+    """Key of a recording: how it was parsed (the tags) and a hash of the file contents.
+
+    filename can also be a file-like object, see as_source.
+    """
+    return '-'.join([str(tag) for tag in tags] + [file_digest(filename)])
+
+
+def load(key):
+    """Return (meta, data) for a cached recording, or None if it is not in the cache.
+
+    data is a read-only memory map of shape (rows, len(meta['columns'])).
+    """
+    metapath = os.path.join(CACHE_FOLDER, key + '.json')
+    datapath = os.path.join(CACHE_FOLDER, key + '.f8')
+    try:
+        with open(metapath) as f:
+            meta = json.load(f)
+        # touch the entry so it counts as recently used
+        os.utime(metapath)
+        os.utime(datapath)
+        # another process can evict the entry up to the moment it is mapped, and not after
+        return meta, mapped(datapath, meta)
+    except (OSError, ValueError):
+        return None
+
+
+def mapped(datapath, meta):
+    shape = (meta['rows'], len(meta['columns']))
+    if meta['rows'] == 0:
+        return np.empty(shape)
+    return np.memmap(datapath, dtype='<f8', mode='r', shape=shape)
+
+
+def store(key, meta, data):
+    """Add a recording to the cache. meta needs 'columns'; 'rows' is filled in here. Returns what load would."""
+    return store_blocks(key, meta, [data])
+
+
+def store_blocks(key, meta, blocks):
+    """Like store, but the data arrives as row blocks and never has to be in memory at once.
+
+    meta is only written once the last block is in, so the blocks may still fill it in.
+    Returns (meta, data) like load. The data is mapped before the entry is moved into place,
+    so it stays readable even if the entry is evicted right away by another process.
+    """
+    os.makedirs(CACHE_FOLDER, exist_ok=True)
+
+    # write to temporary files and move them into place, so a concurrent reader
+    # never sees half an entry. the json goes last because load() starts from it.
+    rows = 0
+    fd, tmppath = tempfile.mkstemp(dir=CACHE_FOLDER, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for block in blocks:
+                block = np.ascontiguousarray(block, dtype='<f8')
+                block.tofile(f)
+                rows += block.shape[0]
+        meta = dict(meta, rows=rows)
+        data = mapped(tmppath, meta)
+        os.replace(tmppath, os.path.join(CACHE_FOLDER, key + '.f8'))
+    except BaseException:
+        os.remove(tmppath)
+        raise
+
+    fd, tmppath = tempfile.mkstemp(dir=CACHE_FOLDER, suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(meta, f)
+    os.replace(tmppath, os.path.join(CACHE_FOLDER, key + '.json'))
+
+    evict(keep=key)
+    return meta, data
+
+
+def evict(max_bytes=None, keep=None):
+    if max_bytes is None:
+        max_bytes = CACHE_MAX_BYTES
+
+    entries = []
+    total = 0
+    for name in os.listdir(CACHE_FOLDER):
+        if not name.endswith('.json'):
+            continue
+        key = name[:-len('.json')]
+        try:
+            used = os.path.getmtime(os.path.join(CACHE_FOLDER, name))
+            size = sum(os.path.getsize(os.path.join(CACHE_FOLDER, key + suffix)) for suffix in ('.json', '.f8'))
+        except OSError:
+            continue
+        entries.append((used, size, key))
+        total += size
+
+    # oldest first
+    for used, size, key in sorted(entries):
+        if total <= max_bytes:
+            break
+        # the entry that was just written stays, even if it is bigger than the whole cache
+        if key == keep:
+            continue
+        for suffix in ('.json', '.f8'):
+            try:
+                os.remove(os.path.join(CACHE_FOLDER, key + suffix))
+            except OSError:
+                pass
+        total -= size
@@ -0,0 +1,88 @@
+"""Results of the speed calculation, kept so a file that is processed again is answered at once.
+
+The results live in a small SQLite database next to the recording cache, which every
+Gunicorn worker can read and write. Least recently used results are deleted once the
+database holds more than RESULT_CACHE_MAX_BYTES of them.
+"""
+import json
+import os
+import sqlite3
+import time
+import recording_cache
+
+
+RESULT_CACHE_PATH = os.environ.get('RESULT_CACHE_PATH',
+                                   os.path.join(recording_cache.CACHE_FOLDER, 'results.sqlite3'))
+RESULT_CACHE_MAX_BYTES = int(os.environ.get('RESULT_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+# results bigger than this are not kept at all
+RESULT_MAX_BYTES = 1024 * 1024
+# part of every key. change it when the speed calculation changes, so old results are not used
+RESULT_VERSION = 1
+
+
+def connect():
+    # a connection per call keeps this safe to use from any thread or process. a database that is busy
+    # or broken raises sqlite3.Error here too, which get and put treat as a miss
+    os.makedirs(os.path.dirname(os.path.abspath(RESULT_CACHE_PATH)), exist_ok=True)
+    db = sqlite3.connect(RESULT_CACHE_PATH, timeout=30)
+    db.execute('PRAGMA journal_mode=WAL')
+    db.execute('CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, value TEXT, size INTEGER, used REAL)')
+    return db
+
+
+def result_key(recording, starttime, endtime):
+    """Key of the result for a recording (its recording cache key) and a bias window."""
+    return f'v{RESULT_VERSION}:{recording}:{float(starttime)!r}:{float(endtime)!r}'
+
+
+def get(key):
+    """Return the stored result dict, or None."""
+    db = None
+    try:
+        db = connect()
+        with db:
+            row = db.execute('SELECT value FROM results WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            db.execute('UPDATE results SET used = ? WHERE key = ?', (time.time(), key))
+    except sqlite3.Error as e:
+        print(f'WARNING: the result cache could not be read ({e})')
+        return None
+    finally:
+        if db is not None:
+            db.close()
+    return json.loads(row[0])
+
+
+def put(key, result):
+    """Store a result dict. Its values have to be json serializable."""
+    value = json.dumps(result)
+    if len(value) > RESULT_MAX_BYTES:
+        return
+
+    db = None
+    try:
+        db = connect()
+        with db:
+            db.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)', (key, value, len(value), time.time()))
+            evict(db, keep=key)
+    except sqlite3.Error as e:
+        print(f'WARNING: the result could not be stored in the result cache ({e})')
+    finally:
+        if db is not None:
+            db.close()
+
+
+def evict(db, max_bytes=None, keep=None):
+    if max_bytes is None:
+        max_bytes = RESULT_CACHE_MAX_BYTES
+
+    total = db.execute('SELECT COALESCE(SUM(size), 0) FROM results').fetchone()[0]
+    # oldest first
+    for key, size in db.execute('SELECT key, size FROM results ORDER BY used').fetchall():
+        if total <= max_bytes:
+            break
+        if key == keep:
+            continue
+        db.execute('DELETE FROM results WHERE key = ?', (key,))
+        total -= size
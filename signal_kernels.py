@@ -0,0 +1,128 @@
+"""Vectorized numpy versions of the per-column pandas operations used by both processors.
+
+The arrays are (samples x channels), so every channel is handled in the same pass.
+"""
+import numpy as np
+
+
+def centered_moving_average(values, window):
+    """Centered moving average over axis 0, the same as pandas rolling(window, center=True, min_periods=1).mean().
+
+    The window covers window // 2 samples before each sample and the rest after it. Near the ends it
+    is cut off and averages the samples it still covers. NaNs are skipped, like pandas does.
+    """
+    window = int(window)
+    if window < 1:
+        raise ValueError(f'the moving average window has to be at least 1 sample, not {window}')
+
+    values = np.asarray(values, dtype=np.float64)
+    if values.ndim == 1:
+        return centered_moving_average(values[:, np.newaxis], window)[:, 0]
+
+    n = values.shape[0]
+    before = window // 2
+    after = window - 1 - before
+    # one contiguous row per channel, so the running sums do not stride across the channels
+    channels = np.ascontiguousarray(values.T)
+
+    def window_sums(x):
+        # running sum padded with its first value (0) before and its last value after, so the
+        # sum of the window around sample i is padded[i + window] - padded[i], cut off at the ends
+        padded = np.empty((x.shape[0], before + 1 + n + after))
+        padded[:, :before + 1] = 0
+        np.cumsum(x, axis=1, out=padded[:, before + 1:before + 1 + n])
+        padded[:, before + 1 + n:] = padded[:, before + n:before + n + 1]
+        return padded[:, window:window + n] - padded[:, :n]
+
+    missing = np.isnan(channels)
+    if missing.any():
+        counts = window_sums(~missing)
+        channels[missing] = 0
+    else:
+        samples = np.arange(n)
+        counts = np.minimum(samples + after + 1, n) - np.maximum(samples - before, 0)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (window_sums(channels) / counts).T
+
+
+def masked_sum(values, mask):
+    """Return (sums, counts) of every column of values over the rows where mask is True.
+
+    NaNs are skipped. Every column is summed as one contiguous run, so the sums come out the same as
+    pandas Series.sum of the selected rows.
+    """
+    selected = np.ascontiguousarray(np.asarray(values, dtype=np.float64)[mask].T)
+    return np.nansum(selected, axis=1), np.count_nonzero(~np.isnan(selected), axis=1)
+
+
+def masked_mean(values, mask):
+    """Mean of every column of values over the rows where mask is True, NaN for columns without any."""
+    sums, counts = masked_sum(values, mask)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return sums / counts
+
+
+def window_mask(time, start, end):
+    # rows with start <= time <= end
+    return (time >= start) & (time <= end)
+
+
+def subtract_bias(values, biases, columns):
+    """Subtract biases from the given columns of values, in place. Returns values."""
+    values[:, columns] -= np.asarray(biases, dtype=np.float64)
+    return values
+
+
+def minmax_indices(values, buckets):
+    """Indices of the samples to keep when a signal is drawn buckets pixels wide.
+
+    The samples are split into buckets runs of equal length, and the smallest and the largest
+    sample of every run are kept, so peaks and spikes survive. The indices come out sorted and
+    always include the first and the last sample. NaNs are never picked over a number.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    n = len(values)
+    if n <= 2 * buckets:
+        return np.arange(n)
+
+    size = -(-n // buckets)
+    runs = np.full(buckets * size, np.nan)
+    runs[:n] = values
+    runs = runs.reshape(buckets, size)
+    start = np.arange(buckets) * size
+
+    missing = np.isnan(runs)
+    lowest = start + np.where(missing, np.inf, runs).argmin(axis=1)
+    highest = start + np.where(missing, -np.inf, runs).argmax(axis=1)
+
+    indices = np.unique(np.concatenate([[0, n - 1], lowest, highest]))
+    return indices[indices < n]
+
+
+def decimate_for_axes(ax, x, y, xlim=None):
+    """Return the samples of the line (x, y) worth drawing in the matplotlib axes ax, as (x, y).
+
+    Every pixel of the width of ax gets the smallest and the largest sample that falls in it
+    (see minmax_indices), so the line looks the same with a fraction of the points. x has to be
+    increasing. With xlim, only the samples in that range and one on either side of it are drawn.
+    The first, last, smallest and largest samples are always kept, so the automatic axis limits
+    come out the same as with all the samples.
+    """
+    x = np.asarray(x)
+    y = np.asarray(y, dtype=np.float64)
+    pixels = max(1, int(ax.get_window_extent().width))
+
+    if xlim is None:
+        keep = minmax_indices(y, pixels)
+    else:
+        start = max(np.searchsorted(x, xlim[0]) - 1, 0)
+        stop = min(np.searchsorted(x, xlim[1], side='right') + 1, len(x))
+        keep = np.union1d(start + minmax_indices(y[start:stop], pixels), minmax_indices(y, 1))
+    return x[keep], y[keep]
+
+
+def value_range(*arrays):
+    """Return (min, max) over all the arrays together, ignoring NaNs."""
+    return (min(np.nanmin(array) for array in arrays),
+            max(np.nanmax(array) for array in arrays))
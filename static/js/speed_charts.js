@@ -0,0 +1,145 @@
+// draws the plots of the speed result page on canvases, from the decimated series of /speed_series.
+// a few lines, markers and axes are all these plots need, so no charting library is loaded for them
+
+function niceTicks(low, high, count) {
+    // about count round numbers from low to high
+    const rough = (high - low) / count;
+    const magnitude = Math.pow(10, Math.floor(Math.log10(rough)));
+    const step = [1, 2, 5, 10].map(factor => factor * magnitude).find(size => size >= rough);
+    const ticks = [];
+    for (let i = Math.ceil(low / step); i * step <= high; i++) {
+        ticks.push(i * step);
+    }
+    return ticks;
+}
+
+function tickLabel(value) {
+    return String(Number(value.toPrecision(6)));
+}
+
+// lines is a list of {label, color, points: [[x, y], ...]}, with optional dash (a canvas line dash)
+// and markers (draw the points as dots instead of joining them). points with a null y are skipped
+function drawChart(canvas, title, lines) {
+    const width = canvas.clientWidth;
+    const height = canvas.clientHeight;
+    const ratio = window.devicePixelRatio || 1;
+    canvas.width = width * ratio;
+    canvas.height = height * ratio;
+    const ctx = canvas.getContext('2d');
+    ctx.scale(ratio, ratio);
+
+    let xmin = Infinity, xmax = -Infinity, ymin = Infinity, ymax = -Infinity;
+    for (const line of lines) {
+        for (const [x, y] of line.points) {
+            if (y === null) {
+                continue;
+            }
+            xmin = Math.min(xmin, x);
+            xmax = Math.max(xmax, x);
+            ymin = Math.min(ymin, y);
+            ymax = Math.max(ymax, y);
+        }
+    }
+    if (!isFinite(xmin)) {
+        return;
+    }
+    if (xmax === xmin) {
+        xmin -= 1;
+        xmax += 1;
+    }
+    if (ymax === ymin) {
+        ymin -= 1;
+        ymax += 1;
+    }
+    // a little room above and below the lines
+    const margin = (ymax - ymin) * 0.05;
+    ymin -= margin;
+    ymax += margin;
+
+    // plot area, with room for the title above and the tick labels, axis label and legend below
+    const left = 60, right = width - 15, top = 30, bottom = height - 55;
+    const px = x => left + (x - xmin) / (xmax - xmin) * (right - left);
+    const py = y => bottom - (y - ymin) / (ymax - ymin) * (bottom - top);
+
+    ctx.font = '12px sans-serif';
+    ctx.lineWidth = 1;
+    ctx.strokeStyle = '#ddd';
+    ctx.fillStyle = '#333';
+
+    ctx.textAlign = 'center';
+    ctx.textBaseline = 'top';
+    for (const tick of niceTicks(xmin, xmax, 8)) {
+        ctx.beginPath();
+        ctx.moveTo(px(tick), top);
+        ctx.lineTo(px(tick), bottom);
+        ctx.stroke();
+        ctx.fillText(tickLabel(tick), px(tick), bottom + 4);
+    }
+    ctx.fillText('Time (s)', (left + right) / 2, bottom + 20);
+
+    ctx.textAlign = 'right';
+    ctx.textBaseline = 'middle';
+    for (const tick of niceTicks(ymin, ymax, 6)) {
+        ctx.beginPath();
+        ctx.moveTo(left, py(tick));
+        ctx.lineTo(right, py(tick));
+        ctx.stroke();
+        ctx.fillText(tickLabel(tick), left - 4, py(tick));
+    }
+
+    ctx.strokeStyle = '#333';
+    ctx.strokeRect(left, top, right - left, bottom - top);
+
+    ctx.font = 'bold 14px sans-serif';
+    ctx.textAlign = 'center';
+    ctx.textBaseline = 'bottom';
+    ctx.fillText(title, (left + right) / 2, top - 8);
+
+    // the lines, clipped to the plot area
+    ctx.save();
+    ctx.beginPath();
+    ctx.rect(left, top, right - left, bottom - top);
+    ctx.clip();
+    for (const line of lines) {
+        ctx.strokeStyle = line.color;
+        ctx.fillStyle = line.color;
+        ctx.setLineDash(line.dash || []);
+        ctx.beginPath();
+        let joined = false;
+        for (const [x, y] of line.points) {
+            if (y === null) {
+                joined = false;
+            } else if (line.markers) {
+                ctx.moveTo(px(x) + 4, py(y));
+                ctx.arc(px(x), py(y), 4, 0, 2 * Math.PI);
+            } else if (joined) {
+                ctx.lineTo(px(x), py(y));
+            } else {
+                ctx.moveTo(px(x), py(y));
+                joined = true;
+            }
+        }
+        if (line.markers) {
+            ctx.fill();
+        } else {
+            ctx.stroke();
+        }
+    }
+    ctx.restore();
+
+    // legend along the bottom
+    ctx.font = '12px sans-serif';
+    ctx.textAlign = 'left';
+    ctx.textBaseline = 'middle';
+    let x = left;
+    for (const line of lines) {
+        if (!line.label) {
+            continue;
+        }
+        ctx.fillStyle = line.color;
+        ctx.fillRect(x, height - 13, 16, 3);
+        ctx.fillStyle = '#333';
+        ctx.fillText(line.label, x + 20, height - 12);
+        x += 36 + ctx.measureText(line.label).width;
+    }
+}
@@ -0,0 +1,84 @@
+"""Scratch folders for the files of one upload or one job.
+
+Every upload and every job gets its own folder, named by a random id, so concurrent users
+and workers never touch each other's files. Folders that have not changed for WORKSPACE_TTL
+seconds are deleted.
+"""
+import os
+import re
+import shutil
+import time
+import uuid
+
+
+WORKSPACE_FOLDER = os.environ.get('WORKSPACE_FOLDER',
+                                  os.path.join(os.path.abspath(os.path.dirname(__file__)), 'workspaces'))
+# seconds a workspace is kept after it was last used
+WORKSPACE_TTL = int(os.environ.get('WORKSPACE_TTL', 3600))
+# expired workspaces are looked for at most this often, in seconds
+CLEANUP_INTERVAL = 60
+
+last_cleanup = 0
+
+
+def valid_id(workspace_id):
+    # ids come from urls and sessions, so anything that is not one of ours never becomes a path
+    return isinstance(workspace_id, str) and re.fullmatch('[0-9a-f]{32}', workspace_id) is not None
+
+
+def path(workspace_id, *names):
+    return os.path.join(WORKSPACE_FOLDER, workspace_id, *names)
+
+
+def create():
+    """Make a new empty workspace and return its id. Expired workspaces are cleaned up on the way."""
+    global last_cleanup
+    if time.monotonic() - last_cleanup > CLEANUP_INTERVAL:
+        last_cleanup = time.monotonic()
+        cleanup()
+
+    workspace_id = uuid.uuid4().hex
+    os.makedirs(path(workspace_id))
+    return workspace_id
+
+
+def touch(workspace_id):
+    """Mark a workspace as used, so it is kept another WORKSPACE_TTL. Returns False if it is gone."""
+    if not valid_id(workspace_id):
+        return False
+    try:
+        os.utime(path(workspace_id))
+    except OSError:
+        return False
+    return True
+
+
+def remove(workspace_id):
+    if valid_id(workspace_id):
+        shutil.rmtree(path(workspace_id), ignore_errors=True)
+
+
+def cleanup(ttl=None):
+    """Delete the workspaces that have not changed for ttl seconds.
+
+    Adding, replacing or deleting a file in a workspace counts as a change, so a running
+    job keeps its workspace alive by writing its progress.
+    """
+    if ttl is None:
+        ttl = WORKSPACE_TTL
+
+    try:
+        names = os.listdir(WORKSPACE_FOLDER)
+    except OSError:
+        return
+
+    now = time.time()
+    for name in names:
+        if not valid_id(name):
+            continue
+        try:
+            expired = now - os.path.getmtime(path(name)) > ttl
+        except OSError:
+            continue
+        if expired:
+            shutil.rmtree(path(name), ignore_errors=True)